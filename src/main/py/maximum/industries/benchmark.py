@@ -0,0 +1,176 @@
+import getopt, glob, sys, time
+import chess
+import numpy as np
+
+sys.path.append('.')
+sys.path.append('src/main/py')
+import maximum.industries.loader as loader
+
+
+def timed(fn, repeats):
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.time()
+        result = fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# Compare the per-square reference transform with the vectorized one on the same
+# instances, checking that their outputs are bit-identical.
+def bench_transform(filenames, repeats):
+    insts = loader.load_data(filenames)
+    print('%d instances from %d files' % (len(insts), len(filenames)))
+    loop_time, expected = timed(lambda: loader.transform_loop(insts), repeats)
+    fast_time, actual = timed(lambda: loader.transform(insts), repeats)
+    cols = loader.to_columns(insts)
+    cols_time, _ = timed(lambda: loader.transform_columns(cols), repeats)
+    identical = all(np.array_equal(a, b) for a, b in zip(expected, actual))
+    print('transform_loop: %8.3fs' % loop_time)
+    print('transform:      %8.3fs  (%.1fx)' % (fast_time, loop_time / max(fast_time, 1e-9)))
+    print('  of which transform_columns: %8.3fs' % cols_time)
+    print('bit-identical:  %s' % identical)
+    return identical
+
+
+def class_shares(player, outcome, rows):
+    which = np.where(outcome[rows] != 0, (player[rows] == 0) + outcome[rows].astype(int) + 1, 4)
+    return np.bincount(which, minlength=5) / max(1, len(rows))
+
+
+# Compare balance_rows with the array-based balance_sample on the same columns: time,
+# fraction kept, the share of each class among the kept rows, and reproducibility.
+def bench_balance(filenames, repeats):
+    cols = loader.to_columns(loader.load_data(filenames))
+    player, outcome = cols.player, cols.outcome
+    print('%d instances from %d files' % (len(player), len(filenames)))
+    rows_time, rows = timed(lambda: loader.balance_rows(player, outcome), repeats)
+    sample_time, sample = timed(lambda: loader.balance_sample(player, outcome,
+                                                              np.random.default_rng(0)), repeats)
+    again = loader.balance_sample(player, outcome, np.random.default_rng(0))
+    print('                 time  kept    w-loss  b-loss  b-win   w-win   draw')
+    for name, elapsed, kept in [('balance_rows', rows_time, rows), ('balance_sample', sample_time, sample)]:
+        print('%-14s %7.4fs %5.3f  %s' % (name, elapsed, len(kept) / max(1, len(player)),
+                                         '  '.join('%6.3f' % s for s in class_shares(player, outcome, kept))))
+    reproducible = np.array_equal(sample, again)
+    print('reproducible:  %s' % reproducible)
+    return reproducible
+
+
+# positions from random games, from the start position and from one with all castling rights
+def random_positions(num_positions, rng):
+    boards = []
+    while len(boards) < num_positions:
+        board = chess.Board(['r3k2r/pppppppp/8/8/8/8/PPPPPPPP/R3K2R w KQkq - 0 1',
+                             chess.STARTING_FEN][len(boards) % 2])
+        while not board.is_game_over() and len(boards) < num_positions:
+            moves = list(board.legal_moves)
+            board.push(moves[rng.integers(len(moves))])
+            boards.append(board.copy())
+    return boards
+
+
+# Compare the one-hot reference model input encoding with the bitboard one, checking that
+# their outputs are identical.
+def bench_encode(num_positions, repeats):
+    import maximum.industries.play as play
+    boards = random_positions(num_positions, np.random.default_rng(0))
+    print('%d positions' % len(boards))
+    ref_time, expected = timed(lambda: [play.to_model_input_reference(b) for b in boards], repeats)
+    fast_time, actual = timed(lambda: [play.to_model_input(b) for b in boards], repeats)
+    identical = all(np.array_equal(a, b) for a, b in zip(expected, actual))
+    print('to_model_input_reference: %8.3fs' % ref_time)
+    print('to_model_input:           %8.3fs  (%.1fx)' % (fast_time, ref_time / max(fast_time, 1e-9)))
+    print('identical:  %s' % identical)
+    return identical
+
+
+# Play a game between two engines, each searching for movetime milliseconds per move, and
+# return the score of 'white' (1, 0.5 or 0). Games running past max_moves are drawn.
+def play_game(white, black, movetime, max_moves=300):
+    import maximum.industries.play as play
+    white.start()
+    black.start()
+    board = white.board
+    engines = [black, white]
+    while not board.is_game_over() and not play.draw_claimed(board) and len(board.move_stack) < max_moves:
+        mover, other = engines[board.turn], engines[not board.turn]
+        other.make_move(mover.search({'movetime': movetime}))
+    result = board.result() if board.is_game_over() else '1/2-1/2'
+    return {'1-0': 1.0, '0-1': 0.0}.get(result, 0.5)
+
+
+# Compare each symmetry policy of the engine (see Engine.averages_reflections) with evaluating
+# all 4 reflections of every leaf: nodes per second of a fixed number of playouts from the
+# same positions, and the score and Elo difference over num_games games at equal time
+# against an engine evaluating all reflections, alternating colours.
+def bench_symmetry(model_path, args, num_positions, num_games, movetime):
+    import maximum.industries.play as play
+    model = play.load_model(model_path, args)
+    boards = random_positions(num_positions, np.random.default_rng(0))
+    reference = play.Engine(model, dict(args, symm='all'), quiet=True)
+    print('%d positions, %d games of %dms per move' % (len(boards), num_games, movetime))
+    print('policy  nodes/sec  score   elo')
+    for policy in play.SYMMETRY_POLICIES:
+        engine = play.Engine(model, dict(args, symm=policy), quiet=True)
+        nodes = 0
+        elapsed = 0.0
+        for board in boards:
+            engine.start(board.fen())
+            engine.search()
+            nodes += engine.search_nodes
+            elapsed += engine.search_time
+        score = 0.0
+        if policy != 'all':
+            for game in range(num_games):
+                if game % 2 == 0:
+                    score += play_game(engine, reference, movetime)
+                else:
+                    score += 1.0 - play_game(reference, engine, movetime)
+        score = score / num_games if policy != 'all' else 0.5
+        elo = -400 * np.log10(1 / min(max(score, 0.01), 0.99) - 1)
+        print('%-7s %9.1f  %5.3f  %+4.0f' % (policy, nodes / max(elapsed, 1e-9), score, elo))
+    return True
+
+
+def main(argv):
+    opts, args = getopt.getopt(argv, 'hd:n:r:m:a:g:t:', [])
+    opts = dict(opts)
+    if '-h' in opts or len(args) != 1:
+        print('benchmark.py [-h] // help')
+        print('             [-d <data>] // e.g., data/shuffled')
+        print('             [-n <num_files>] // or positions for encode and symmetry')
+        print('             [-r <repeats>]')
+        print('             [-m <model>] // for symmetry, e.g., tfmodels/r14/1549380964')
+        print('             [-a <args>] // engine args for symmetry, e.g., iter=200,back=numpy')
+        print('             [-g <num_games>] // games per policy for symmetry')
+        print('             [-t <movetime>] // milliseconds per move for symmetry')
+        print('             transform|balance|encode|symmetry')
+        exit()
+
+    data_pattern = opts['-d'] if '-d' in opts else 'shuffled'
+    num_files = int(opts['-n']) if '-n' in opts else 6
+    repeats = int(opts['-r']) if '-r' in opts else 3
+
+    filenames = sorted(glob.glob('%s.*.done' % data_pattern))[-num_files:]
+    if args[0] == 'transform':
+        ok = bench_transform(filenames, repeats)
+    elif args[0] == 'balance':
+        ok = bench_balance(filenames, repeats)
+    elif args[0] == 'encode':
+        ok = bench_encode(int(opts['-n']) if '-n' in opts else 2000, repeats)
+    elif args[0] == 'symmetry':
+        from maximum.industries.play import argdict
+        ok = bench_symmetry(opts['-m'], argdict(opts['-a']) if '-a' in opts else {},
+                            int(opts['-n']) if '-n' in opts else 60,
+                            int(opts['-g']) if '-g' in opts else 20,
+                            int(opts['-t']) if '-t' in opts else 200)
+    else:
+        raise Exception('invalid benchmark')
+    exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
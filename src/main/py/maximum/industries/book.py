@@ -0,0 +1,162 @@
+import getopt, glob, os, shutil, sys
+import numpy as np
+
+sys.path.append('.')
+sys.path.append('src/main/py')
+import maximum.industries.columnar as columnar
+import maximum.industries.loader as loader
+
+#
+# Opening book built from self-play data. Training instances are grouped by position (board
+# state and player to move), and each position seen at least min_count times is stored with
+# the number of instances, their average outcome for the player to move, and their tree
+# search results averaged over the instances, weighted by the visits of each search (see
+# search_visits), i.e. the share of all visits at the position that went to each move. A
+# book is a directory of .npy files:
+#
+#   key.npy      (n,)    uint64   position_keys of the positions, sorted
+#   count.npy    (n,)    int32    number of instances of each position
+#   outcome.npy  (n,)    float32  average outcome for the player to move
+#   offset.npy   (n+1,)  int64    policy entries of position i are offset[i]:offset[i+1]
+#   index.npy    (m,)    uint16   policy index of each entry
+#   prob.npy     (m,)    float32  visit-weighted average probability of each entry
+#
+# Lookups binary search the memory-mapped keys, so a book can be much larger than memory.
+#
+
+BOOK_TYPES = {
+    'key': np.uint64,
+    'count': np.int32,
+    'outcome': np.float32,
+    'offset': np.int64,
+    'index': np.uint16,
+    'prob': np.float32,
+}
+
+
+def _mix(h):
+    # splitmix64 finalizer
+    h = h ^ (h >> np.uint64(30))
+    h = h * np.uint64(0xbf58476d1ce4e5b9)
+    h = h ^ (h >> np.uint64(27))
+    h = h * np.uint64(0x94d049bb133111eb)
+    return h ^ (h >> np.uint64(31))
+
+
+# 64-bit hashes of (n, 64) board_state bytes and n players
+def position_keys(board, player):
+    words = np.ascontiguousarray(board, dtype=np.uint8).view('<u8')
+    h = np.zeros(len(words), dtype=np.uint64)
+    for i in range(8):
+        h = _mix(h ^ words[:, i])
+    return _mix(h ^ np.asarray(player).astype(np.uint64))
+
+
+# The number of visits of the search behind each row of a Columns, which the data does not
+# record. Its probabilities are visits / total visits of the root's children, so the total
+# is 1 / the smallest probability whenever some child had a single visit, as nearly all do
+# after a search, and otherwise a whole multiple of it. Rows without visits get 0.
+def search_visits(cols):
+    counts = np.diff(cols.offset)
+    smallest = np.full(len(counts), np.inf)
+    np.minimum.at(smallest, np.repeat(np.arange(len(counts)), counts),
+                  np.where(cols.prob > 0, cols.prob, np.inf))
+    return np.where(np.isfinite(smallest), np.round(1 / smallest), 0)
+
+
+# group the rows of a Columns by position, keeping positions with at least min_count rows,
+# and averaging their probabilities weighted by 'visits' (by default search_visits)
+def aggregate(cols, min_count, visits=None):
+    visits = search_visits(cols) if visits is None else np.asarray(visits, dtype=np.float64)
+    keys, inverse, count = np.unique(position_keys(cols.board, cols.player),
+                                     return_inverse=True, return_counts=True)
+    outcome = np.bincount(inverse, weights=cols.outcome, minlength=len(keys)) / count
+    # sum the visits of each (position, policy index), ordered by position
+    counts = np.diff(cols.offset)
+    entry_row = np.repeat(inverse, counts)
+    entry_visits = np.repeat(visits, counts) * cols.prob
+    pairs, pair_inverse = np.unique(entry_row * 4096 + cols.index, return_inverse=True)
+    prob = np.bincount(pair_inverse, weights=entry_visits, minlength=len(pairs))
+    pair_row, index = pairs // 4096, pairs % 4096
+    position_visits = np.bincount(inverse, weights=visits, minlength=len(keys))[pair_row]
+    prob = np.divide(prob, position_visits, out=np.zeros_like(prob), where=position_visits > 0)
+
+    kept = count >= min_count
+    kept_pairs = kept[pair_row]
+    pair_count = np.bincount(pair_row[kept_pairs], minlength=len(keys))[kept]
+    offset = np.zeros(kept.sum() + 1, dtype=np.int64)
+    np.cumsum(pair_count, out=offset[1:])
+    return {'key': keys[kept],
+            'count': count[kept],
+            'outcome': outcome[kept],
+            'offset': offset,
+            'index': index[kept_pairs],
+            'prob': prob[kept_pairs]}
+
+
+def write_book(path, book):
+    work = '%s.work' % path
+    if os.path.isdir(work):
+        shutil.rmtree(work)
+    os.mkdir(work)
+    for field, dtype in BOOK_TYPES.items():
+        np.save('%s/%s.npy' % (work, field), book[field].astype(dtype))
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(work, path)
+
+
+class Book(object):
+
+    def __init__(self, path):
+        for field in BOOK_TYPES:
+            setattr(self, field, np.load('%s/%s.npy' % (path, field), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.key)
+
+    # (count, outcome, policy indices, probabilities) of a position, or None if not in the book
+    def lookup(self, board_state, player):
+        board = np.frombuffer(board_state, dtype=np.uint8).reshape(1, 64)
+        key = position_keys(board, [player])[0]
+        i = np.searchsorted(self.key, key)
+        if i == len(self.key) or self.key[i] != key:
+            return None
+        start, end = self.offset[i], self.offset[i + 1]
+        return int(self.count[i]), float(self.outcome[i]), self.index[start:end], self.prob[start:end]
+
+
+def main(argv):
+    opts, _ = getopt.getopt(argv, 'hd:o:n:c:', ['data=', 'out='])
+    opts = dict(opts)
+    if '-h' in opts:
+        print('book.py [-h] // help')
+        print('        [-d|--data <data>] // e.g., data/shuffled')
+        print('        [-o|--out <book>] // output directory, e.g., data/book')
+        print('        [-n <from_last_n>] // only use the most recent files')
+        print('        [-c <min_count>] // only keep positions seen this often')
+        exit()
+
+    data_pattern = opts['-d'] if '-d' in opts else opts.get('--data', 'shuffled')
+    book_path = opts['-o'] if '-o' in opts else opts.get('--out', 'book')
+    from_last_n = int(opts['-n']) if '-n' in opts else 0
+    min_count = int(opts['-c']) if '-c' in opts else 3
+
+    filenames = sorted(glob.glob('%s.*.done' % data_pattern))[-from_last_n:]
+    chosen = []
+    for filename in filenames:
+        # use the columnar form of a file where it has been converted
+        path = columnar.columnar_name(filename)
+        if os.path.isdir(path):
+            chosen.append(columnar.read_columns(path))
+        else:
+            chosen.append(loader.to_columns(loader.load_data([filename])))
+    cols = loader.concat_columns(chosen)
+    book = aggregate(cols, min_count)
+    print('%d instances from %d files, %d positions seen at least %d times' %
+          (len(cols.board), len(filenames), len(book['key']), min_count))
+    write_book(book_path, book)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,44 @@
+import collections
+
+#
+# Bounded LRU cache of network evaluations. Entries are keyed by the polyglot Zobrist hash
+# of a position, which covers the pieces, side to move, castling rights and any capturable
+# en passant square, i.e. everything the model input and the legal moves depend on, and by
+# whether the evaluation averages the 4 reflections or uses a single one (see
+# Engine.averages_reflections). Each entry holds what Engine.expand needs: the value and
+# the prior of each legal move, in legal move order.
+#
+# A cache outlives the moves and games of the engines using it, so positions reached by
+# transposition within a search, or again later in the same or another game, are
+# evaluated only once.
+#
+
+
+class EvalCache(object):
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return entry
+
+    # add an entry, evicting the least recently used ones beyond capacity
+    def put(self, key, entry):
+        if self.capacity <= 0:
+            return
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
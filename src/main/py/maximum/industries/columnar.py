@@ -0,0 +1,101 @@
+import getopt, glob, os, shutil, sys
+import numpy as np
+
+sys.path.append('.')
+sys.path.append('src/main/py')
+import maximum.industries.loader as loader
+
+#
+# Columnar on-disk format for training data. Each data.chess2.*.done file of varint
+# delimited TrainingInstance protos is converted to a directory of .npy files, one per
+# field of loader.Columns:
+#
+#   board.npy        (n, 64) uint8    board_state bytes
+#   player.npy       (n,)    int8
+#   outcome.npy      (n,)    int8
+#   game_length.npy  (n,)    int32
+#   offset.npy       (n+1,)  int64    tree search results of row i are offset[i]:offset[i+1]
+#   index.npy        (m,)    uint16   policy index of each tree search result
+#   prob.npy         (m,)    float32  probability of each tree search result
+#
+# Directories are written with a .work suffix and renamed when complete, so readers never
+# see partial data. Reading memory-maps every column, so sampling rows does not parse or
+# copy anything beyond the rows that are used.
+#
+
+COLUMN_TYPES = {
+    'board': np.uint8,
+    'player': np.int8,
+    'outcome': np.int8,
+    'game_length': np.int32,
+    'offset': np.int64,
+    'index': np.uint16,
+    'prob': np.float32,
+}
+
+
+def columnar_name(filename):
+    return '%s.cols' % os.path.splitext(filename)[0]
+
+
+def write_columns(path, cols):
+    work = '%s.work' % path
+    if os.path.isdir(work):
+        shutil.rmtree(work)
+    os.mkdir(work)
+    for field in loader.Columns._fields:
+        np.save('%s/%s.npy' % (work, field), getattr(cols, field).astype(COLUMN_TYPES[field]))
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(work, path)
+
+
+def read_columns(path):
+    return loader.Columns(**{field: np.load('%s/%s.npy' % (path, field), mmap_mode='r')
+                             for field in loader.Columns._fields})
+
+
+def convert(filename):
+    path = columnar_name(filename)
+    write_columns(path, loader.to_columns(loader.load_data([filename])))
+    return path
+
+
+# Columnar equivalents of loader.load_balance and loader.load_balance_transform. Only the
+# balanced rows of each chosen file are read from the memory-mapped columns.
+def load_balance(pattern, choose_n, from_last_n=0, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    chosen = []
+    for path in loader.choose_files(pattern, choose_n, from_last_n, rng):
+        cols = read_columns(path)
+        rows = loader.balance_sample(cols.player, cols.outcome, rng)
+        chosen.append(loader.take_columns(cols, rows))
+    return loader.concat_columns(chosen)
+
+
+def load_balance_transform(pattern, choose_n, from_last_n=0, rng=None, sparse_width=0):
+    return loader.transform_columns(load_balance(pattern, choose_n, from_last_n, rng),
+                                    sparse_width=sparse_width)
+
+
+def main(argv):
+    opts, _ = getopt.getopt(argv, 'hd:f', ['data='])
+    opts = dict(opts)
+    if '-h' in opts:
+        print('columnar.py [-h] // help')
+        print('            [-f] // reconvert files that were already converted')
+        print('            [-d|--data <data>] // e.g., data/shuffled')
+        exit()
+
+    data_pattern = opts['-d'] if '-d' in opts else opts.get('--data', 'shuffled')
+    force = '-f' in opts
+
+    filenames = sorted(glob.glob('%s.*.done' % data_pattern))
+    for filename in filenames:
+        if force or not os.path.isdir(columnar_name(filename)):
+            print('converting %s' % filename)
+            convert(filename)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
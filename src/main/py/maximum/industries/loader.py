@@ -1,12 +1,15 @@
+import collections
 import glob
 import numpy as np
 from google.protobuf.internal.decoder import _DecodeVarint32
 import maximum.industries.instance_pb2 as instance_pb2
+from maximum.industries.policy import FLIP_POLICY
 
 #
-# Use np.random for any random numbers drawn in this module. When this module is
-# called in worker processes main.py will ensure that each call has a new numpy
-# RandomState.
+# Functions in this module that draw random numbers take an explicit np.random.Generator,
+# defaulting to a freshly seeded one, so that train.py can reproduce the exact data
+# pipeline of each worker process from a seed. The original balance_rows and balance
+# still use np.random; train.py reseeds its global RandomState in each worker process.
 #
 
 DTYPE = 'float32'  # can set this to 'float16', but this breaks batch normalization.
@@ -64,7 +67,152 @@ def adjust_entropy(probs):
     return probs
 
 
+# adjust_entropy applied to each of the segments offset[i]:offset[i+1] of a flat array of
+# probabilities, with bit-identical results. Segments of the same length are adjusted
+# together as the rows of a 2-d array, whose row sums add the elements in the same order
+# as sum() on each segment would (np.add.reduceat does not), and each round of sharpening
+# is applied only to the rows whose entropy is still too high. Chess positions have few
+# distinct numbers of moves, so this loops over tens of lengths rather than every position.
+def adjust_entropy_segments(prob, offset):
+    probs = np.zeros(len(prob), dtype=np.float64)
+    counts = np.diff(offset)
+    metf = 0.4
+    for length in np.unique(counts[counts > 0]):
+        entries = (offset[:-1][counts == length] - offset[0]).reshape(-1, 1) + np.arange(length)
+        block = prob[entries].astype(np.float64)
+        max_entropy = -((1 - metf) * np.log((1 - metf) / length) - metf * np.log(metf))
+        block += 0.001
+        block /= block.sum(axis=1, keepdims=True)
+        active = np.arange(len(block))
+        for _ in range(15):
+            rows = block[active]
+            active = active[(-rows * np.log(rows)).sum(axis=1) > max_entropy]
+            if len(active) == 0:
+                break
+            rows = block[active]
+            rows **= 1.5
+            rows += 0.001
+            rows /= rows.sum(axis=1, keepdims=True)
+            block[active] = rows
+        probs[entries] = block
+    return probs
+
+
+# Column-oriented view of a list of training instances. 'board' is an (n, 64) uint8 array of
+# board_state bytes, and the tree search results of instance i are the entries
+# offset[i]:offset[i+1] of the flat 'index' and 'prob' arrays (CSR layout).
+Columns = collections.namedtuple('Columns', ['board', 'player', 'outcome', 'game_length',
+                                             'offset', 'index', 'prob'])
+
+
+def to_columns(insts):
+    n = len(insts)
+    board = np.frombuffer(b''.join([inst.board_state for inst in insts]), dtype=np.uint8)
+    counts = np.array([len(inst.tree_search_result) for inst in insts], dtype=np.int64)
+    offset = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=offset[1:])
+    return Columns(board=board.reshape(n, 64),
+                   player=np.array([inst.player for inst in insts], dtype=np.int8),
+                   outcome=np.array([inst.outcome for inst in insts], dtype=np.int8),
+                   game_length=np.array([inst.game_length for inst in insts], dtype=np.int32),
+                   offset=offset,
+                   index=np.array([tsr.index for inst in insts for tsr in inst.tree_search_result],
+                                  dtype=np.int32),
+                   prob=np.array([tsr.prob for inst in insts for tsr in inst.tree_search_result],
+                                 dtype=np.float32))
+
+
+# Lookup table for the vectorized transform. PIECE_CHANNELS[reverse_sides][p] is the input
+# channel of board byte p, with empty squares (and invalid bytes) mapped to channel 0 which
+# is overwritten by the player plane. The policy indices of the reflections are looked up
+# in FLIP_POLICY from policy.py.
+def _piece_channels():
+    table = np.array([[piece_to_channel(p, reverse_sides) for p in range(256)]
+                      for reverse_sides in (False, True)])
+    table[table >= NUM_INPUT_CHANNELS] = 0
+    return table
+
+
+PIECE_CHANNELS = _piece_channels()
+
+
+# Width of the y_policy rows transform_columns produces. A dense policy target has one
+# column per policy index. A sparse target of width k holds up to k (index, prob) pairs:
+# columns 0..k-1 are policy indices (as floats) and columns k..2k-1 their probabilities,
+# padded with zero probabilities. See modeldef.sparse_policy_loss.
+def policy_width(sparse_width=0):
+    return 2 * sparse_width if sparse_width > 0 else 8 * 8 * 8 * 8
+
+
+# Vectorized equivalent of transform_loop, producing bit-identical output. The four
+# reflections of instance k are rows 4k..4k+3, in the same order as transform_loop. If
+# 'out' is given it must be a tuple of preallocated (x_input, y_value, y_policy) arrays
+# with 4 * len(cols.board) rows, which are filled in place. If sparse_width is given the
+# policy target is sparse (see policy_width), keeping the sparse_width most probable moves
+# of positions that have more, renormalized to sum to 1 like the dense target.
+def transform_columns(cols, out=None, sparse_width=0):
+    if sparse_width > 0 and np.dtype(DTYPE) != np.float32:
+        raise Exception('sparse policy targets hold policy indices as %s, which needs float32' %
+                        DTYPE)
+    k = len(cols.board)
+    n = k * 4
+    if out is None:
+        x_input = np.zeros((n, NUM_INPUT_CHANNELS, 8, 8), dtype=DTYPE)
+        y_value = np.zeros((n, 1), dtype=DTYPE)
+        y_policy = np.zeros((n, policy_width(sparse_width)), dtype=DTYPE)
+    else:
+        x_input, y_value, y_policy = out
+        y_policy.fill(0)
+
+    # input planes: reflect the raw boards, then one-hot the looked-up channels.
+    board = cols.board.reshape(k, 8, 8)
+    boards = np.stack((board, board[:, :, ::-1], board[:, ::-1, :], board[:, ::-1, ::-1]), axis=1)
+    reverse_sides = np.array([0, 0, 1, 1]).reshape(1, 4, 1, 1)
+    channels = PIECE_CHANNELS[reverse_sides, boards].reshape(n, 1, 8, 8)
+    x_input[:] = channels == np.arange(NUM_INPUT_CHANNELS).reshape(1, NUM_INPUT_CHANNELS, 1, 1)
+    player_sign = np.where(cols.player == 0, 1, -1).reshape(k, 1) * np.array([1, 1, -1, -1])
+    x_input[:, 0, :, :] = player_sign.reshape(n, 1, 1)
+
+    y_value[:, 0] = np.repeat(cols.outcome.astype(np.float64) * 0.98, 4)
+
+    # policy: adjust entropy of all instances, then merge entries of an instance that share
+    # a policy index (under-promotions share the queen promotion's) by adding their
+    # probabilities, then scatter all reflections in one step.
+    probs = adjust_entropy_segments(cols.prob, cols.offset)
+    entry_inst = np.repeat(np.arange(k), np.diff(cols.offset))
+    keys, inverse = np.unique(entry_inst * 4096 + cols.index.astype(np.int64), return_inverse=True)
+    probs = np.bincount(inverse.ravel(), weights=probs, minlength=len(keys))
+    entry_inst, index = keys // 4096, keys % 4096
+    counts = np.bincount(entry_inst, minlength=k)
+    offset = np.zeros(k + 1, dtype=np.int64)
+    np.cumsum(counts, out=offset[1:])
+    rows = 4 * entry_inst.reshape(1, -1) + np.arange(4).reshape(4, 1)
+    if sparse_width > 0:
+        # position of each entry within its row, by descending probability for rows that
+        # have to be truncated.
+        pos = np.arange(len(probs)) - np.repeat(offset[:-1], counts)
+        for i in np.flatnonzero(counts > sparse_width):
+            start, end = offset[i], offset[i + 1]
+            pos[start:end] = np.argsort(np.argsort(-probs[start:end], kind='stable'))
+            kept_sum = probs[start:end][pos[start:end] < sparse_width].sum()
+            if kept_sum > 0:
+                probs[start:end] /= kept_sum
+        keep = pos < sparse_width
+        rows, pos = rows[:, keep].ravel(), np.tile(pos[keep], 4)
+        y_policy[rows, pos] = FLIP_POLICY[:, index[keep]].ravel()
+        y_policy[rows, pos + sparse_width] = np.tile(probs[keep], 4)
+    else:
+        y_policy[rows.ravel(), FLIP_POLICY[:, index].ravel()] = np.tile(probs, 4)
+    return x_input, y_value, y_policy
+
+
 def transform(insts):
+    return transform_columns(to_columns(insts))
+
+
+# Straightforward per-square implementation of transform. This is kept as the reference
+# the vectorized version is checked against (see benchmark.py).
+def transform_loop(insts):
     n = len(insts) * 4
     x_input = np.zeros((n, NUM_INPUT_CHANNELS, 8, 8), dtype=DTYPE)
     y_value = np.zeros((n, 1), dtype=DTYPE)
@@ -83,28 +231,89 @@ def transform(insts):
         x_input[i, 0, :, :] = (1 if inst.player == 0 else -1) * (-1 if reverse_sides else 1)
         y_value[i, 0] = inst.outcome * 0.98
         probs = adjust_entropy(np.array([tsr.prob for tsr in inst.tree_search_result]))
+        merged = {}
         for j in range(len(inst.tree_search_result)):
             tsr = inst.tree_search_result[j]
-            y_policy[i, flip_policy_index(tsr.index, flip_left_right, reverse_sides)] = probs[j]
+            merged[tsr.index] = merged.get(tsr.index, 0.0) + probs[j]
+        for index, prob in merged.items():
+            y_policy[i, flip_policy_index(index, flip_left_right, reverse_sides)] = prob
     return x_input, y_value, y_policy
 
 
-def balance(insts):
+# Decide which rows to keep, aiming for wins and losses of each side to be equally
+# represented and including about 10% of draws. Returns the kept row numbers.
+def balance_rows(player, outcome):
     out = []
     total = 0
     counts = [0, 0, 0, 0]
-    for inst in insts:
-        if inst.outcome != 0:
-            which = (1 if inst.player == 0 else 0) + inst.outcome + 1
+    for i in range(len(outcome)):
+        if outcome[i] != 0:
+            which = (1 if player[i] == 0 else 0) + int(outcome[i]) + 1
             prob = 0.30 if (counts[which] + 1.0) / (total + 1.0) > 0.25 else 0.4
             if np.random.uniform() < prob:
-                out.append(inst)
+                out.append(i)
                 total += 1
                 counts[which] += 1
         else:
             if np.random.uniform() < 0.1:
-                out.append(inst)
-    return out
+                out.append(i)
+    return np.array(out, dtype=np.int64)
+
+
+def balance(insts):
+    rows = balance_rows([inst.player for inst in insts], [inst.outcome for inst in insts])
+    return [insts[i] for i in rows]
+
+
+# Array-based, stratified version of balance_rows. Decisive rows are split into four
+# classes (win/loss for each side) and each class is sampled at the rate that would make
+# it a quarter of a 35% sample, clipped to the 30%-40% range balance_rows switches
+# between. About 10% of draws are kept. Returns the kept row numbers in ascending order.
+def balance_sample(player, outcome, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    player = np.asarray(player)
+    outcome = np.asarray(outcome).astype(np.int64)
+    which = np.where(outcome != 0, (player == 0) + outcome + 1, 4)
+    counts = np.bincount(which, minlength=5)
+    rates = np.append(np.clip(0.0875 * counts[:4].sum() / np.maximum(counts[:4], 1), 0.3, 0.4), 0.1)
+    keep_n = rng.binomial(counts, rates)
+    rows = [rng.choice(np.flatnonzero(which == k), keep_n[k], replace=False) for k in range(5)]
+    return np.sort(np.concatenate(rows)).astype(np.int64)
+
+
+# Gather the given rows of a Columns, including their slices of the CSR policy arrays.
+# Works on memory-mapped columns, reading only the pages the rows live in.
+def take_columns(cols, rows):
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = cols.offset[rows]
+    counts = cols.offset[rows + 1] - starts
+    offset = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offset[1:])
+    entries = np.repeat(starts - offset[:-1], counts) + np.arange(offset[-1])
+    return Columns(board=cols.board[rows],
+                   player=cols.player[rows],
+                   outcome=cols.outcome[rows],
+                   game_length=cols.game_length[rows],
+                   offset=offset,
+                   index=cols.index[entries],
+                   prob=cols.prob[entries])
+
+
+def concat_columns(cols_list):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    base = 0
+    for cols in cols_list:
+        offsets.append(cols.offset[1:] - cols.offset[0] + base)
+        base += cols.offset[-1] - cols.offset[0]
+    return Columns(board=np.concatenate([cols.board for cols in cols_list]),
+                   player=np.concatenate([cols.player for cols in cols_list]),
+                   outcome=np.concatenate([cols.outcome for cols in cols_list]),
+                   game_length=np.concatenate([cols.game_length for cols in cols_list]),
+                   offset=np.concatenate(offsets),
+                   index=np.concatenate([cols.index[cols.offset[0]:cols.offset[-1]]
+                                         for cols in cols_list]),
+                   prob=np.concatenate([cols.prob[cols.offset[0]:cols.offset[-1]]
+                                        for cols in cols_list]))
 
 
 def load_data(filenames):
@@ -128,9 +337,21 @@ def load_data(filenames):
     return allinsts
 
 
-def load_balance_transform(pattern, choose_n, from_last_n=0):
+def choose_files(pattern, choose_n, from_last_n=0, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
     filenames = glob.glob(pattern)
     filenames.sort()
     filenames = filenames[-from_last_n:]
-    filenames = [filenames[i] for i in np.random.randint(0, len(filenames), choose_n)]
-    return transform(balance(load_data(filenames)))
+    return [filenames[i] for i in rng.integers(0, len(filenames), choose_n)]
+
+
+def load_balance(pattern, choose_n, from_last_n=0, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    insts = load_data(choose_files(pattern, choose_n, from_last_n, rng))
+    rows = balance_sample([inst.player for inst in insts], [inst.outcome for inst in insts], rng)
+    return to_columns([insts[i] for i in rows])
+
+
+def load_balance_transform(pattern, choose_n, from_last_n=0, rng=None, sparse_width=0):
+    return transform_columns(load_balance(pattern, choose_n, from_last_n, rng),
+                             sparse_width=sparse_width)
@@ -1,4 +1,5 @@
 import os, time
+import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import backend as K
@@ -9,6 +10,7 @@ from tensorflow.keras.optimizers import Adam
 from tensorflow.keras import initializers
 from tensorflow.keras.regularizers import l2
 from tensorflow.compat.v1.graph_util import convert_variables_to_constants
+from tensorflow.tools.graph_transforms import TransformGraph
 from google.protobuf.internal.encoder import _VarintBytes
 from google.protobuf.internal.decoder import _DecodeVarint32
 from maximum.industries.loader import NUM_INPUT_CHANNELS, DTYPE
@@ -45,32 +47,58 @@ def get_norm(freeze_batch_norm, name, scale=True):
             if freeze_batch_norm else
             BatchNormalization(axis=1, scale=scale, name=name))
 
-def get_residual_block(x1, freeze_batch_norm, i):
+# In an inference model the normalization and dropout layers are left out, and the weights
+# of the trained model are loaded with its normalizations folded in (see folded_weights).
+def get_residual_block(x1, freeze_batch_norm, i, inference=False):
     filters = K.int_shape(x1)[1]
     x2 = get_conv(filters=filters, activation=None)(x1)
-    x2 = get_norm(freeze_batch_norm, 'batchnorm-%d-a' % i, scale=False)(x2)
+    if not inference:
+        x2 = get_norm(freeze_batch_norm, 'batchnorm-%d-a' % i, scale=False)(x2)
     x2 = Activation(tf.nn.relu)(x2)
     x2 = get_conv(filters=filters, activation=None)(x2)
-    x2 = get_norm(freeze_batch_norm, 'batchnorm-%d-b' % i, scale=True)(x2)
+    if not inference:
+        x2 = get_norm(freeze_batch_norm, 'batchnorm-%d-b' % i, scale=True)(x2)
     x2 = Add()([x1, x2])
     return Activation(tf.nn.relu)(x2)
 
-def make_model(filters=160, blocks=8, kernels=(5,1), rate=0.001, freeze_batch_norm=False):
+# Cross entropy loss for sparse policy targets (see loader.policy_width). The first half of
+# each target row holds policy indices and the second half their probabilities, so we
+# gather the predicted probabilities at those indices rather than comparing with a dense
+# 4096 wide target. Padding entries have zero probability and do not contribute.
+def sparse_policy_loss(y_true, y_pred):
+    width = tf.shape(y_true)[1] // 2
+    index = tf.cast(y_true[:, :width], tf.int32)
+    prob = y_true[:, width:]
+    rows = tf.tile(tf.expand_dims(tf.range(tf.shape(y_pred)[0]), 1), [1, width])
+    picked = tf.gather_nd(y_pred, tf.stack([rows, index], axis=2))
+    picked = K.clip(picked, K.epsilon(), 1.0 - K.epsilon())
+    return -tf.reduce_sum(prob * tf.log(picked), axis=1)
+
+def compile_model(model, optimizer, sparse_policy=False):
+    policy_loss = sparse_policy_loss if sparse_policy else 'categorical_crossentropy'
+    losses = { 'value': 'mean_squared_error', 'policy': policy_loss }
+    weights = { 'value': 1.0, 'policy': 1.0 }
+    model.compile(optimizer=optimizer, loss=losses, loss_weights=weights, metrics=[])
+
+def make_model(filters=160, blocks=8, kernels=(5,1), rate=0.001, freeze_batch_norm=False,
+               sparse_policy=False, inference=False):
     input = Input(shape=(NUM_INPUT_CHANNELS, 8, 8), name='input')
 
     # initial convolution
     x = get_conv(filters=filters, kernel_size=kernels[0])(input)
     
     # residual blocks
-    for i in range(blocks): x = get_residual_block(x, freeze_batch_norm, i)
+    for i in range(blocks): x = get_residual_block(x, freeze_batch_norm, i, inference)
 
     # value tower
     vt = Flatten()(x)
     vt = get_dense(40, regu=0.02)(vt)
-    vt = Dropout(rate=0.5)(vt)
-    vt = get_norm(freeze_batch_norm, 'batchnorm-vt')(vt)
+    if not inference:
+        vt = Dropout(rate=0.5)(vt)
+        vt = get_norm(freeze_batch_norm, 'batchnorm-vt')(vt)
     vt = get_dense(20, regu=0.04)(vt)
-    vt = Dropout(rate=0.5)(vt)
+    if not inference:
+        vt = Dropout(rate=0.5)(vt)
     value = Dense(1, activation=tf.nn.tanh, name='value',
                   kernel_initializer=initializers.glorot_normal(),
                   bias_initializer=initializers.zeros(),
@@ -84,21 +112,120 @@ def make_model(filters=160, blocks=8, kernels=(5,1), rate=0.001, freeze_batch_no
     policy = Softmax(name='policy')(pf)
 
     model = Model(inputs=input, outputs=[value, policy])
-    losses = { 'value': 'mean_squared_error', 'policy': 'categorical_crossentropy' }
-    weights = { 'value': 1.0, 'policy': 1.0 }
-    optimizer = Adam(rate)
-    model.compile(optimizer=optimizer, loss=losses, loss_weights=weights, metrics=[])
+    compile_model(model, Adam(rate), sparse_policy)
 
     print('Model parameters: %d' % model.count_params())
     return model
 
-def save_model(model, output_dir):
+def is_normalization(layer):
+    return isinstance(layer, (BatchNormalization, FixedNormalization))
+
+def weighted_layers(model):
+    return [l for l in model.layers if isinstance(l, (Conv2D, Dense))]
+
+# The Conv2D and Dense layers of a model by their role, which is the same in the model made
+# for training and for inference: 'conv0' for the input layer's convolution, then 'conv1',
+# 'conv2', ... for those of the residual blocks and the policy head's, in the order of the
+# network, and their names for the Dense layers. Layers cannot be paired by position in
+# model.layers, as Keras orders them by depth in the graph, which leaving out normalization
+# and dropout changes, nor by name for the convolutions, whose names are generated.
+def layer_roles(model):
+    convs = [l for l in model.layers if isinstance(l, Conv2D)]
+    roles = {'conv%d' % i: l for i, l in enumerate(convs)}
+    roles.update({l.name: l for l in model.layers if isinstance(l, Dense)})
+    return roles
+
+# Weights of the Conv2D and Dense layers of a trained model by layer name, with every
+# normalization folded into an adjacent layer. A normalization computes x * scale + shift
+# per channel, with
+#
+#   scale = gamma / sqrt(moving_variance + epsilon),  shift = beta - moving_mean * scale
+#
+# When it directly follows a layer (as in the residual blocks) that layer's kernel and bias
+# are scaled per output channel and the shift is added to the bias. The value tower's
+# normalization follows a relu and dropout instead, so it is folded into the Dense layer it
+# feeds: the rows of that kernel are scaled and shift @ kernel is added to its bias. Folding
+# is done in float64 and the results cast back to DTYPE.
+def folded_weights(model):
+    weights = {l.name: [w.astype(np.float64) for w in l.get_weights()] for l in weighted_layers(model)}
+    producer = {id(l.output): l for l in model.layers}
+    for norm in filter(is_normalization, model.layers):
+        params = [w.astype(np.float64) for w in norm.get_weights()]
+        gamma = params.pop(0) if norm.scale else 1.0
+        beta = params.pop(0) if norm.center else 0.0
+        mean, variance = params
+        scale = gamma / np.sqrt(variance + norm.epsilon)
+        shift = beta - mean * scale
+        before = producer.get(id(norm.input))
+        after = [l for l in model.layers if l.input is norm.output]
+        if isinstance(before, (Conv2D, Dense)) and before.activation in (None, keras.activations.linear):
+            kernel, bias = weights[before.name]
+            weights[before.name] = [kernel * scale, bias * scale + shift]
+        elif len(after) == 1 and isinstance(after[0], Dense):
+            kernel, bias = weights[after[0].name]
+            weights[after[0].name] = [kernel * scale[:, None], bias + shift @ kernel]
+        else:
+            raise Exception('cannot fold normalization %s' % norm.name)
+    return {name: [w.astype(DTYPE) for w in ws] for name, ws in weights.items()}
+
+# Export the folded weights of a trained model to a .npz for npmodel.NumpyModel. Kernels
+# keep their Keras layout, and the two convolutions of the residual blocks are stacked over
+# blocks. As in save_model, the first convolution is the input layer's and the last the
+# policy head's.
+def export_numpy(model, path):
+    folded = folded_weights(model)
+    convs = [folded[l.name] for l in model.layers if isinstance(l, Conv2D)]
+    blocks = convs[1:-1]
+    arrays = {'input_kernel': convs[0][0], 'input_bias': convs[0][1],
+              'policy_kernel': convs[-1][0], 'policy_bias': convs[-1][1]}
+    for half, layers in [('a', blocks[0::2]), ('b', blocks[1::2])]:
+        arrays['block_%s_kernel' % half] = np.stack([kernel for kernel, _ in layers])
+        arrays['block_%s_bias' % half] = np.stack([bias for _, bias in layers])
+    for i, name in enumerate(['dense_40_relu', 'dense_20_relu', 'value']):
+        arrays['value_%d_kernel' % (i + 1)], arrays['value_%d_bias' % (i + 1)] = folded[name]
+    np.savez(path, **arrays)
+
+# Graph transforms applied to the frozen inference graph. Freezing already drops everything
+# the outputs do not depend on (optimizer, loss and regularization ops), so what is left is
+# cleaning up after it: identity nodes from reading variables, constant subexpressions and
+# duplicated constants.
+GRAPH_TRANSFORMS = ['remove_nodes(op=Identity, op=CheckNumerics)',
+                    'fold_constants(ignore_errors=true)',
+                    'fold_batch_norms',
+                    'merge_duplicate_nodes',
+                    'sort_by_execution_order']
+OUTPUT_NODE_NAMES = ['value/Tanh', 'policy/Softmax']
+
+# Largest absolute differences (value, policy) between the outputs of a Keras model and of
+# a SavedModel written by save_model on the same inputs, which must be at most 'tolerance'.
+PARITY_TOLERANCE = 1e-4
+
+def check_parity(model, export_dir, inputs, tolerance=PARITY_TOLERANCE):
+    expected_value, expected_policy = model.predict(inputs)
+    with tf.Graph().as_default():
+        with tf.Session() as sess:
+            tf.saved_model.loader.load(sess, [tf.saved_model.tag_constants.SERVING], export_dir)
+            value, policy = sess.run(['%s:0' % name for name in OUTPUT_NODE_NAMES],
+                                     feed_dict={'input:0': inputs})
+    differences = (float(np.max(np.abs(value - expected_value))),
+                   float(np.max(np.abs(policy - expected_policy))))
+    if max(differences) > tolerance:
+        raise Exception('SavedModel %s differs from model: value %g, policy %g' %
+                        ((export_dir,) + differences))
+    return differences
+
+# Save a reloadable .h5 for training, an inference-optimized SavedModel for play and the same
+# weights as a .npz for the numpy backend. The SavedModel has no normalization or dropout ops
+# (see folded_weights) and keeps the node names input, value/Tanh and policy/Softmax used on
+# the java side. If parity_inputs are given, the
+# SavedModel's outputs are checked against the model's on them (see check_parity).
+def save_model(model, output_dir, parity_inputs=None):
     timestamp = int(time.time())
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
     model.save('%s/%d.h5' % (output_dir, timestamp)) # save reloadable .h5 so we can restart training
-    tmp_name = '/tmp/weights-%s.h5' % timestamp
-    model.save_weights(tmp_name)
+    weights = folded_weights(model)
+    export_numpy(model, '%s/%d.npz' % (output_dir, timestamp))
 
     # determine the number of filters and blocks in the model
     last_add = [l for l in model.layers if 'add' in l.name][-1]
@@ -109,23 +236,28 @@ def save_model(model, output_dir):
     
     with tf.Graph().as_default():
         with tf.Session().as_default() as freeze_sess:
-            # in new graph and session create an identical model, except with custom batch normalization
-            # layers that can be frozen without any training ops.
-            model2 = make_model(filters=filters, blocks=blocks, kernels=kernels, freeze_batch_norm=True)
-            # load weights into the new network and get a frozen graph def.
-            model2.load_weights(tmp_name)
-            os.remove(tmp_name)
-            freeze_var_names = [v.name for v in model2.variables]
-            output_node_names = ['input', 'value/Tanh', 'policy/Softmax']
-            output_node_names += [v.op.name for v in model2.variables]
+            # in new graph and session create the same network without normalization and dropout
+            # layers, and load the folded weights into it.
+            model2 = make_model(filters=filters, blocks=blocks, kernels=kernels, inference=True)
+            roles = layer_roles(model2)
+            for role, layer in layer_roles(model).items():
+                roles[role].set_weights(weights[layer.name])
             input_graph_def = freeze_sess.graph.as_graph_def()
-            frozen_graph_def = convert_variables_to_constants(freeze_sess, 
+            frozen_graph_def = convert_variables_to_constants(freeze_sess,
                                                               input_graph_def,
-                                                              output_node_names)
-            # create a new graph and sesion containing the frozen graph and save
+                                                              OUTPUT_NODE_NAMES)
+            optimized_graph_def = TransformGraph(frozen_graph_def, ['input'], OUTPUT_NODE_NAMES,
+                                                 GRAPH_TRANSFORMS)
+            print('Frozen graph: %d nodes, optimized: %d nodes' %
+                  (len(frozen_graph_def.node), len(optimized_graph_def.node)))
+            # create a new graph and sesion containing the optimized graph and save
             with tf.Graph().as_default():
                 with tf.Session().as_default() as save_sess:
-                    tf.graph_util.import_graph_def(frozen_graph_def, name='')
+                    tf.graph_util.import_graph_def(optimized_graph_def, name='')
                     builder = tf.saved_model.builder.SavedModelBuilder('%s/%d' % (output_dir, timestamp))
                     builder.add_meta_graph_and_variables(save_sess, [tf.saved_model.tag_constants.SERVING])
                     builder.save(False)
+
+    if parity_inputs is not None:
+        print('SavedModel max difference from model: value %g, policy %g' %
+              check_parity(model, '%s/%d' % (output_dir, timestamp), parity_inputs))
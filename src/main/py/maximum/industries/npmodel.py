@@ -0,0 +1,110 @@
+import getopt, sys
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+sys.path.append('.')
+sys.path.append('src/main/py')
+
+#
+# Forward pass of the modeldef network in NumPy, from the .npz written by
+# modeldef.export_numpy, so that engines can evaluate positions without loading TensorFlow.
+# Normalizations are already folded into the kernels and biases, so each layer is a single
+# matrix product. A KxK 'same' convolution multiplies the KxK patch around every square
+# (im2col, taken from a strided view of the zero padded input) by the kernel reshaped to
+# (in * K * K, out). Activations are kept channels-last, (n, 8, 8, channels), and are put
+# back in the channels-first order of the Keras model before flattening.
+#
+
+
+# (kh, kw, in, out) Keras kernel as an (in * kh * kw, out) matrix, in the order of the
+# patches taken by conv
+def kernel_matrix(kernel):
+    return np.ascontiguousarray(kernel.transpose(2, 0, 1, 3).reshape(-1, kernel.shape[-1]))
+
+
+def conv(x, matrix, bias, k):
+    n, h, w, _ = x.shape
+    if k > 1:
+        p = k // 2
+        x = np.pad(x, ((0, 0), (p, p), (p, p), (0, 0)))
+        x = sliding_window_view(x, (k, k), axis=(1, 2))  # (n, h, w, in, k, k)
+    return (x.reshape(n * h * w, -1) @ matrix + bias).reshape(n, h, w, -1)
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def channels_first_flat(x):
+    return x.transpose(0, 3, 1, 2).reshape(len(x), -1)
+
+
+class NumpyModel(object):
+
+    def __init__(self, path):
+        with np.load(path) as arrays:
+            arrays = {name: arrays[name].astype(np.float32) for name in arrays.files}
+
+        def layer(kernel, bias):
+            return kernel_matrix(kernel), bias, kernel.shape[0]
+
+        self.input = layer(arrays['input_kernel'], arrays['input_bias'])
+        self.blocks = [(layer(*a), layer(*b)) for a, b in
+                       zip(zip(arrays['block_a_kernel'], arrays['block_a_bias']),
+                           zip(arrays['block_b_kernel'], arrays['block_b_bias']))]
+        self.policy = layer(arrays['policy_kernel'], arrays['policy_bias'])
+        self.value = [(arrays['value_%d_kernel' % i], arrays['value_%d_bias' % i])
+                      for i in [1, 2, 3]]
+
+    # returns (value, policy) for a batch of model inputs, like play.Model
+    def evaluate(self, inputs):
+        x = np.asarray(inputs, dtype=np.float32).transpose(0, 2, 3, 1)
+        x = relu(conv(x, *self.input))
+        for a, b in self.blocks:
+            x = relu(x + conv(relu(conv(x, *a)), *b))
+
+        vt = channels_first_flat(x)
+        (w1, b1), (w2, b2), (w3, b3) = self.value
+        vt = relu(vt @ w1 + b1)
+        vt = relu(vt @ w2 + b2)
+        value = np.tanh(vt @ w3 + b3)
+
+        logits = channels_first_flat(conv(x, *self.policy))
+        policy = np.exp(logits - logits.max(axis=1, keepdims=True))
+        policy /= policy.sum(axis=1, keepdims=True)
+        return value, policy
+
+
+# Export the .npz for a model saved before save_model wrote one, and compare the numpy
+# forward pass with the Keras model on random positions.
+def main(argv):
+    opts, _ = getopt.getopt(argv, 'hm:o:n:', [])
+    opts = dict(opts)
+    if '-h' in opts or '-m' not in opts:
+        print('npmodel.py [-h] // help')
+        print('           -m <model.h5> // e.g., tfmodels/r14/1549380964.h5')
+        print('           [-o <model.npz>] // defaults to the model path with .npz')
+        print('           [-n <num_positions>] // positions to compare on')
+        exit()
+
+    h5_path = opts['-m']
+    npz_path = opts['-o'] if '-o' in opts else '%s.npz' % h5_path.rsplit('.h5', 1)[0]
+    num_positions = int(opts['-n']) if '-n' in opts else 256
+
+    import maximum.industries.modeldef as modeldef
+    import maximum.industries.play as play
+    from maximum.industries.benchmark import random_positions
+    from tensorflow.keras.models import load_model
+    model = load_model(h5_path, custom_objects={'sparse_policy_loss': modeldef.sparse_policy_loss})
+    modeldef.export_numpy(model, npz_path)
+
+    boards = random_positions(num_positions, np.random.default_rng(0))
+    inputs = np.concatenate([play.to_model_input(b) for b in boards])
+    expected_value, expected_policy = model.predict(inputs)
+    value, policy = NumpyModel(npz_path).evaluate(inputs)
+    print('wrote %s, max difference from model: value %g, policy %g' %
+          (npz_path, np.max(np.abs(value - expected_value)), np.max(np.abs(policy - expected_policy))))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,19 +1,29 @@
 import chess
 import chess.pgn
+import chess.polyglot
+import contextlib
 import getopt
+import io
+import json
+import multiprocessing
 import os
+import queue
 import sys
 import scipy.special
 import numpy as np
-import tensorflow as tf
+import threading
 import time
 from ast import literal_eval
-from tensorflow.keras import backend as K
 from google.protobuf.internal import encoder
 
 sys.path.append('.')
 sys.path.append('src/main/py')
 import maximum.industries.instance_pb2 as instance_pb2
+from maximum.industries.book import Book
+from maximum.industries.cache import EvalCache
+from maximum.industries.policy import POLICY_INDEX, move_squares
+from maximum.industries.profiler import NullProfiler, Profiler
+from maximum.industries.tree import Tree, move_code, code_move
 
 
 def to_channel_array(board):
@@ -36,7 +46,57 @@ def to_channel_array(board):
     return x
 
 
+# the board_state bytes of a TrainingInstance: channels 1-8 as is, and 9-16 as -1 to -8
+def to_board_state(board):
+    x = to_channel_array(board).reshape(64)
+    return np.where(x <= 8, x, 256 - (x - 8)).astype(np.uint8).tobytes()
+
+
+# Model input encoding straight from bitboards. Each of input channels 1-16 is a 64-bit
+# mask of the squares it covers, whose bytes are the ranks, so the reflections are byte
+# reversal (ranks) and bit reversal within bytes (files) before the masks are unpacked
+# into planes. See to_model_input_reference for the plain definition of the encoding.
+REVERSED_BYTES = np.array([int('{:08b}'.format(i)[::-1], 2) for i in range(256)], dtype=np.uint8)
+# the order of channels after swapping sides: white pieces 1-8 and black pieces 9-16
+SWAP_SIDES = [0] + list(range(9, 17)) + list(range(1, 9))
+CASTLING_SQUARES = [(chess.WHITE, 0, chess.BB_A1 | chess.BB_H1, chess.BB_E1),
+                    (chess.BLACK, 8, chess.BB_A8 | chess.BB_H8, chess.BB_E8)]
+
+
+# the mask of each input channel, as in to_channel_array: piece types, plus rooks that can
+# still castle and their king in channels 7 and 8 (and 15 and 16 for black).
+def channel_masks(board):
+    masks = [0] * 17
+    for color, offset, rooks, king in CASTLING_SQUARES:
+        unmoved = board.castling_rights & rooks
+        unmoved_king = king if unmoved else 0
+        for piece_type in range(1, 7):
+            masks[offset + piece_type] = board.pieces_mask(piece_type, color) & ~(unmoved | unmoved_king)
+        masks[offset + 7] = unmoved
+        masks[offset + 8] = unmoved_king
+    return np.array(masks, dtype='<u8')
+
+
+# write the model inputs of a board, in all 4 reflections, into 'out' of shape (4, 17, 8, 8),
+# e.g. a slice of a preallocated batch.
+def encode_board(board, out):
+    ranks = channel_masks(board).view(np.uint8).reshape(17, 8)
+    flipped = ranks[:, ::-1]
+    planes = np.stack((ranks, REVERSED_BYTES[ranks], flipped[SWAP_SIDES], REVERSED_BYTES[flipped[SWAP_SIDES]]))
+    out[:] = np.unpackbits(planes, axis=2, bitorder='little').reshape(4, 17, 8, 8)
+    out[0:2, 0, :, :] = 1 if board.turn else -1
+    out[2:4, 0, :, :] = -1 if board.turn else 1
+
+
 def to_model_input(board):
+    out = np.empty((4, 17, 8, 8), dtype=np.float32)
+    encode_board(board, out)
+    return out
+
+
+# Reference definition of to_model_input, one-hot encoding to_channel_array. This is kept to
+# check encode_board against (see benchmark.py).
+def to_model_input_reference(board):
     x = to_channel_array(board)
     # broadcast convert to 17x8x8 input
     y = 1 * (np.arange(17).reshape((17, 1, 1)) == x)
@@ -48,15 +108,13 @@ def to_model_input(board):
     return z
 
 
+# the reflections of the model input, in the order encode_board writes them
+ALL_REFLECTIONS = np.arange(4)
+SYMMETRY_POLICIES = ['all', 'one', 'root', 'visits']
+
+
 def policy_index(move, rotation):
-    uci = move.uci()
-    r1, c1 = int(uci[1]) - 1, ord(uci[0]) - ord('a')
-    r2, c2 = int(uci[3]) - 1, ord(uci[2]) - ord('a')
-    if rotation % 2 > 0:
-        c1, c2 = 7 - c1, 7 - c2
-    if rotation > 1:
-        r1, r2 = 7 - r1, 7 - r2
-    return 64 * (8 * r1 + c1) + (8 * r2 + c2)
+    return int(POLICY_INDEX[rotation, move.from_square, move.to_square])
 
 
 def score_to_odds(score):
@@ -73,22 +131,226 @@ def draw_claimed(state):
     return len(state.move_stack) > 0 and state.move_stack[-1].uci() == '0000'
 
 
-class Engine(object):
-    
-    def __init__(self, model_path, args, quiet=False):
+def is_terminal(state):
+    return state.is_game_over() or draw_claimed(state)
+
+
+class Model(object):
+
+    def __init__(self, model_path):
+        # TensorFlow is only imported by engines that use it, as it takes seconds to load.
+        import tensorflow as tf
         # Rather than using load_model('model.h5') to get a keras model, we'll load
         # the same frozen model we use on the java side since this runs faster. Keras
         # complains when we try to construct a Model from the input and output tensors
         # so we'll use the lower level tensorflow session.run API.
+        config = tf.ConfigProto()
+        config.gpu_options.allow_growth = True
         self.graph = tf.Graph()
-        self.session = tf.Session(graph=self.graph)
+        self.session = tf.Session(graph=self.graph, config=config)
         _ = tf.saved_model.loader.load(self.session,
                                        [tf.saved_model.tag_constants.SERVING],
                                        model_path)
         self.input = self.graph.get_tensor_by_name('input:0')
         self.outputs = [self.graph.get_tensor_by_name('value/Tanh:0'),
                         self.graph.get_tensor_by_name('policy/Softmax:0')]
-        
+
+    # returns (value, policy) for a batch of model inputs
+    def evaluate(self, inputs):
+        return self.session.run(self.outputs, feed_dict={self.input: inputs})
+
+
+# Load the model at 'model_path' for the backend chosen by args['back']: 'tf' runs the frozen
+# SavedModel in TensorFlow, 'numpy' the .npz that modeldef.save_model writes next to it (see
+# npmodel.py), which needs no TensorFlow at all, and 'tflite' a quantized model written by
+# quantize.py, of the kind given by args['quan'] (int8 by default). For numpy and tflite,
+# 'model_path' may also be the converted file itself. With 'server', 'model_path' is instead
+# the socket of a server.py that evaluates positions for all the engines of a node.
+def load_model(model_path, args):
+    backend = args['back'] if 'back' in args else 'tf'
+    if backend == 'tf':
+        return Model(model_path)
+    if backend == 'numpy':
+        from maximum.industries.npmodel import NumpyModel
+        return NumpyModel(model_path if model_path.endswith('.npz') else
+                          '%s.npz' % model_path.rstrip('/'))
+    if backend == 'tflite':
+        from maximum.industries.quantize import TFLiteModel, tflite_name
+        kind = args['quan'] if 'quan' in args else 'int8'
+        return TFLiteModel(model_path if model_path.endswith('.tflite') else
+                           tflite_name(model_path, kind))
+    if backend == 'server':
+        from maximum.industries.server import RemoteModel
+        return RemoteModel(model_path)
+    raise Exception('unknown backend %s' % backend)
+
+
+# (value, policy) for model inputs of 'positions' positions, which are one row each or all
+# four reflections (see SYMMETRY_POLICIES). Models that batch the requests of several
+# searches, an Evaluator or a server's RemoteModel, set takes_positions and are told the
+# number of positions, so that their batches are sized in positions rather than rows.
+def evaluate_positions(model, inputs, positions):
+    if getattr(model, 'takes_positions', False):
+        return model.evaluate(inputs, positions)
+    return model.evaluate(inputs)
+
+
+# A thread that evaluates model inputs submitted by several search threads in shared
+# batches. Each batch is started by one request and filled with further requests until it
+# has max_batch positions or max_latency seconds have passed, and is then run through the
+# model in a single call. session.run releases the GIL, so search threads keep traversing
+# the tree while a batch is being evaluated.
+class Evaluator(object):
+    takes_positions = True
+
+    def __init__(self, model, max_batch, max_latency, profiler=NullProfiler()):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.profiler = profiler
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    # returns (value, policy) for a batch of model inputs of 'positions' positions,
+    # blocking until it is evaluated, or raises what the model raised evaluating its batch
+    def evaluate(self, inputs, positions):
+        request = [inputs, positions, threading.Event(), None]
+        self.requests.put(request)
+        request[2].wait()
+        if isinstance(request[3], BaseException):
+            raise request[3]
+        return request[3]
+
+    def loop(self):
+        while True:
+            batch = [self.requests.get()]
+            positions = batch[0][1]
+            deadline = time.time() + self.max_latency
+            while positions < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(0.0, deadline - time.time())))
+                except queue.Empty:
+                    break
+                positions += batch[-1][1]
+            self.profiler.observe('evaluator_batch', positions)
+            start = self.profiler.clock()
+            try:
+                inputs = np.concatenate([request[0] for request in batch])
+                value, policy = evaluate_positions(self.model, inputs, positions)
+            except Exception as e:
+                for request in batch:
+                    request[3] = e
+                    request[2].set()
+                continue
+            self.profiler.lap('evaluator_run', start)
+            start = 0
+            for request in batch:
+                end = start + len(request[0])
+                request[3] = (value[start:end], policy[start:end])
+                request[2].set()
+                start = end
+
+
+# Context managers holding a lock for the duration of a block, and releasing a held lock
+# for the duration of a block, which do nothing without a lock.
+@contextlib.contextmanager
+def held(lock):
+    if lock is None:
+        yield
+    else:
+        with lock:
+            yield
+
+
+@contextlib.contextmanager
+def released(lock):
+    if lock is None:
+        yield
+        return
+    lock.release()
+    try:
+        yield
+    finally:
+        lock.acquire()
+
+
+# The limits of one search: how many playouts it may run and until when, and whether it
+# should end before then. Infinite and ponder searches only end when the engine's
+# stop_search is set, though on ponder_hit a ponder search continues as a timed search
+# from then on, keeping its playouts. With limits from a go command a search also ends
+# early once the choice of move is decided. Any search ends when stop_search is set. No
+# search ends, for any reason, before it has completed at least one playout, so that the
+# root is expanded and there is a move to play.
+class SearchControl(object):
+
+    def __init__(self, engine, limits, info):
+        self.engine = engine
+        self.limits = limits
+        self.info = info
+        self.start = time.time()
+        self.last_info = self.start
+        self.max_playouts, self.deadline = engine.budget(limits, self.start)
+        self.pondering = limits is not None and 'ponder' in limits
+        self.can_stop_early = limits and 'infinite' not in limits and not self.pondering
+        self.start_visits = engine.tree.visits[0]
+        self.start_cache = (engine.cache.hits, engine.cache.misses)
+        engine.search_nodes = 0
+        engine.search_time = 0.0
+
+    # whether to end the search after 'done' playouts, calling 'info' when it is due
+    def should_stop(self, done):
+        engine = self.engine
+        now = time.time()
+        engine.search_nodes, engine.search_time = done, now - self.start
+        if done == 0:
+            return False
+        if done >= self.max_playouts:
+            return True
+        if engine.stop_search.is_set():
+            return True
+        if self.pondering and engine.ponder_hit.is_set():
+            self.pondering = False
+            self.can_stop_early = True
+            self.limits = {k: v for k, v in self.limits.items() if k != 'ponder'}
+            self.max_playouts, self.deadline = engine.budget(self.limits, now)
+            self.max_playouts += done
+        if self.deadline is not None and now >= self.deadline:
+            return True
+        if (self.can_stop_early and
+                engine.decided(self.max_playouts - done, self.deadline, now)):
+            return True
+        if self.info is not None and now - self.last_info >= INFO_INTERVAL:
+            self.info()
+            self.last_info = now
+        return False
+
+    # record the totals of the search and call 'info' a last time, while the root is still
+    # the position searched, before the engine makes its move
+    def finish(self, done):
+        engine = self.engine
+        engine.search_nodes, engine.search_time = done, time.time() - self.start
+        if self.info is not None:
+            self.info()
+        if engine.profiler.enabled:
+            # reuse is the share of the root's final visits that came from earlier searches
+            visits = engine.tree.visits[0]
+            engine.last_profile = engine.profiler.report(
+                move=len(engine.board.move_stack), nodes=done, seconds=round(engine.search_time, 6),
+                nps=round(engine.nps(), 1), tree_size=int(engine.tree.size),
+                reuse_ratio=round(float(self.start_visits / max(1, visits)), 4),
+                cache_hits=engine.cache.hits - self.start_cache[0],
+                cache_misses=engine.cache.misses - self.start_cache[1])
+
+
+class Engine(object):
+    
+    # 'model' is either a model path, or a model (see load_model) that may be shared by
+    # several engines, and likewise 'cache' an EvalCache to share, or None to create one of
+    # size args['cach'].
+    def __init__(self, model, args, quiet=False, cache=None):
+        self.model = load_model(model, args) if isinstance(model, str) else model
+
         self.iterations = int(args['iter']) if 'iter' in args else 200
         self.exploration = float(args['expl']) if 'expl' in args else 0.3
         self.temperature = float(args['temp']) if 'temp' in args else 0.1
@@ -102,16 +364,57 @@ class Engine(object):
         self.policy_add_value_and_prior = int(args['pavp']) if 'pavp' in args else 0
         self.take_or_avoid_knowns = int(args['toak']) if 'toak' in args else 0
         self.move_choice_value_quantile = float(args['mcvq']) if 'mcvq' in args else 0
+        self.leaf_batch = int(args['leaf']) if 'leaf' in args else 1
+        self.virtual_loss = float(args['vlos']) if 'vlos' in args else 1.0
+        self.cache_size = int(args['cach']) if 'cach' in args else 100000
+        self.move_overhead = float(args['ovhd']) if 'ovhd' in args else 50
+        self.moves_to_go = int(args['mtgo']) if 'mtgo' in args else 30
+        self.search_threads = int(args['thrd']) if 'thrd' in args else 1
+        self.eval_batch = int(args['ebat']) if 'ebat' in args else self.search_threads * self.leaf_batch
+        self.eval_latency = float(args['elat']) if 'elat' in args else 5
+        self.book_path = args['book'] if 'book' in args else None
+        self.book_min_count = int(args['bkmn']) if 'bkmn' in args else 50
+        self.book_mix = float(args['bkmx']) if 'bkmx' in args else 0.5
+        self.profile = int(args['prof']) if 'prof' in args else 0
+        self.profile_log = args['plog'] if 'plog' in args else None
+        self.symmetry = args['symm'] if 'symm' in args else 'all'
+        self.symmetry_depth = int(args['symd']) if 'symd' in args else 2
+        self.symmetry_visits = float(args['symv']) if 'symv' in args else 16
+        if self.symmetry not in SYMMETRY_POLICIES:
+            raise Exception('unknown symmetry policy %s' % self.symmetry)
 
+        # evaluates the leaves of multi-threaded searches, started by the first one
+        self.evaluator = None
+        # the opening book (see book.py), and the book policy to mix into the priors of the
+        # root when it is expanded
+        self.book = Book(self.book_path) if self.book_path else None
+        self.root_book = None
+        # the root position (zobrist hash and ply) whose priors the book policy was last
+        # mixed into, so that searching it again does not mix it in again
+        self.book_root = None
+        # instrumentation of searches (see profiler.py), and the report of the last one
+        self.profiler = (Profiler(self.profile_log) if self.profile or self.profile_log
+                         else NullProfiler())
+        self.last_profile = None
+
+        self.cache = cache if cache is not None else EvalCache(self.cache_size)
+
+        # the search tree, whose node 0 is always the root (see tree.py)
         self.board = chess.Board(fen=chess.STARTING_FEN)
-        self.root = [None, 0, 0.0, 0.0]
+        self.tree = Tree()
         self.training_data = []
         self.quiet = quiet
+        # playouts and seconds taken by the last search
+        self.search_nodes = 0
+        self.search_time = 0.0
+        # set from another thread to end a search, or to turn a ponder search into a timed one
+        self.stop_search = threading.Event()
+        self.ponder_hit = threading.Event()
 
     # start a new game, optionally from a given position
     def start(self, fen=chess.STARTING_FEN):
         self.board = chess.Board(fen=fen)
-        self.root = [None, 0, 0.0, 0.0]
+        self.tree.reset()
         self.training_data = []
 
     def position(self, toks):
@@ -137,24 +440,22 @@ class Engine(object):
                 self.make_move(move)
                 return
         self.board = sync
-        self.root = [None, 0, 0.0, 0.0]
+        self.tree.reset()
 
     # return a training instance with everything set but the outcome and game length
     def get_training_instance(self):
         inst = instance_pb2.TrainingInstance()
         inst.player = instance_pb2.WHITE if self.board.turn else instance_pb2.BLACK
-        channel_arr = to_channel_array(self.board).reshape(64)
-        board_state = bytearray(64)
-        for i in range(64):
-            board_state[i] = channel_arr[i] if channel_arr[i] <= 8 else 256 - (channel_arr[i] - 8)
-        inst.board_state = bytes(board_state)
-        policy_sum = 0 if not self.root[0] else sum([self.root[0][m][1] for m in self.root[0]])
-        for move in self.root[0]:
+        inst.board_state = to_board_state(self.board)
+        children = self.tree.children(0)
+        policy_sum = self.tree.visits[children].sum()
+        for child in children:
+            move = code_move(self.tree.move[child])
             if move.uci() != '0000':
                 tsr = inst.tree_search_result.add()
                 tsr.index = policy_index(move, 0)
                 tsr.type = instance_pb2.MOVE_PROB
-                tsr.prob = self.root[0][move][1] / policy_sum if policy_sum > 0 else 0.0
+                tsr.prob = self.tree.visits[child] / policy_sum if policy_sum > 0 else 0.0
         return inst
 
     def save_training_data(self, f, outcome, game_length):
@@ -169,22 +470,91 @@ class Engine(object):
             f.write(encoder._VarintBytes(inst.ByteSize()))
             f.write(inst.SerializeToString())
 
-    # search for the best move to make from the current position
-    def search(self):
-        for _ in range(self.iterations):
-            state = self.board.copy()
-            stack = []
-            node = self.root
-            while node[0] is not None and not (state.is_game_over() or draw_claimed(state)):
-                stack.append(node)
-                # Node is previously expanded so we've already computed legal moves.
-                moves = [m for m in node[0].keys()]
-                priorities = [self.priority(node, move) for move in moves]
-                move = moves[np.argmax(priorities)]
-                state.push(move)
-                node = node[0][move]
-            self.expand(state, node)
-            self.backprop(stack, node)
+    # search for the best move to make from the current position. 'limits' are the
+    # parameters of a UCI go command (see parse_go), or None to run self.iterations
+    # playouts. 'info', if given, is called about once every INFO_INTERVAL seconds while
+    # searching.
+    def search(self, limits=None, info=None):
+        if self.search_threads == 1:
+            return self.run(self.search_steps(limits, info))
+        move = self.book_move()
+        if move is None:
+            self.threaded_playouts(limits, info)
+            move = self.finish_search()
+        return move
+
+    # Generator form of search, yielding model inputs and their number of positions as
+    # playouts does, and returning the move made. This lets a driver interleave the searches of several engines.
+    def search_steps(self, limits=None, info=None):
+        move = self.book_move()
+        if move is None:
+            yield from self.playouts(limits, info)
+            move = self.finish_search()
+        return move
+
+    # Look the current position up in the book. A position seen at least
+    # self.book_min_count times is played from the book, sampling its policy at the
+    # current temperature, and is neither searched nor recorded as training data, and the
+    # move is returned. Otherwise the book policy of a position in the book is mixed into
+    # the priors of the root's children, with weight self.book_mix, and None is returned.
+    def book_move(self):
+        self.root_book = None
+        self.last_profile = None
+        if self.book is None:
+            return None
+        entry = self.book.lookup(to_board_state(self.board),
+                                 instance_pb2.WHITE if self.board.turn else instance_pb2.BLACK)
+        if entry is None:
+            return None
+        count, outcome, index, prob = entry
+        if count >= self.book_min_count:
+            moves = list(self.board.legal_moves)
+            probs = self.book_priors(moves, (index, prob))
+            if probs.sum() > 0:
+                probs = probs / probs.sum()
+                probs = probs ** (1 / self.effective_temperature())
+                probs = probs / probs.sum()
+                move = moves[np.random.choice(len(moves), p=probs)]
+                if not self.quiet:
+                    print('Book: %s (%d games, outcome %6.3f)' % (move.uci(), count, outcome))
+                self.make_move(move)
+                return move
+        # the priors of a root kept from an earlier search of the same position already
+        # have the book policy mixed in
+        root = (chess.polyglot.zobrist_hash(self.board), len(self.board.move_stack))
+        if not self.tree.expanded(0):
+            self.root_book = (index, prob)
+        elif self.book_root != root:
+            children = self.tree.children(0)
+            moves = [code_move(code) for code in self.tree.move[children]]
+            # leave the prior of claiming a draw alone
+            real = np.array([bool(m) for m in moves])
+            self.tree.prior[children[real]] = self.mix_book_priors(
+                [m for m in moves if m], self.tree.prior[children[real]], (index, prob))
+        self.book_root = root
+        return None
+
+    # the book probability of each of a list of moves, given a book (index, prob) policy
+    def book_priors(self, moves, book):
+        index, prob = book
+        policy = np.zeros(64 * 64)
+        policy[index] = prob
+        from_squares, to_squares = move_squares(moves)
+        return policy[POLICY_INDEX[0, from_squares, to_squares]]
+
+    def mix_book_priors(self, moves, priors, book):
+        mixed = (1 - self.book_mix) * priors + self.book_mix * self.book_priors(moves, book)
+        return mixed.astype(np.float32)
+
+    # record a training instance for the searched position, then pick and make a move
+    def finish_search(self):
+        if not self.quiet:
+            print('Playouts: %d in %.3fs (%d nps)' % (self.search_nodes, self.search_time,
+                                                      self.nps()))
+            print('Cache: %d hits, %d misses, %d entries' % (self.cache.hits, self.cache.misses,
+                                                              len(self.cache)))
+            if self.last_profile is not None:
+                print('Profile: %s' % json.dumps(self.last_profile))
         self.training_data.append(self.get_training_instance())
         if self.move_choice_value_quantile > 0:
             move = self.pick_move_by_value()
@@ -193,40 +563,335 @@ class Engine(object):
         self.make_move(move)
         return move
 
-    # make a chosen move
+    def nps(self):
+        return self.search_nodes / max(self.search_time, 1e-6)
+
+    # The maximum number of playouts and the deadline (or None) of a search with the given
+    # go parameters. With a movetime the whole of it is used. Otherwise with a clock the
+    # remaining time is shared over the moves to go, plus most of the increment, and never
+    # more than half the remaining time is used. Times are in milliseconds, as in UCI, and
+    # self.move_overhead is kept back for communication.
+    def budget(self, limits, start):
+        if not limits:
+            return self.iterations, None
+        if 'infinite' in limits or 'ponder' in limits:
+            return sys.maxsize, None
+        clock, inc = ('wtime', 'winc') if self.board.turn else ('btime', 'binc')
+        if 'movetime' in limits:
+            millis = limits['movetime'] - self.move_overhead
+        elif clock in limits:
+            moves_to_go = max(1, limits.get('movestogo', self.moves_to_go))
+            millis = limits[clock] / moves_to_go + 0.75 * limits.get(inc, 0)
+            millis = min(millis, limits[clock] / 2) - self.move_overhead
+        else:
+            return limits.get('nodes', self.iterations), None
+        return limits.get('nodes', sys.maxsize), start + max(millis, 1.0) / 1000.0
+
+    # Whether more playouts cannot change the most visited child of the root: either it is
+    # the only move, or its lead in visits over the runner up is more than the number of
+    # playouts still possible within the node limit and, at the current rate, the deadline.
+    def decided(self, remaining, deadline, now):
+        visits = np.sort(self.tree.visits[self.tree.children(0)])
+        if len(visits) < 2:
+            return len(visits) == 1
+        if deadline is not None:
+            remaining = min(remaining, self.nps() * (deadline - now))
+        return visits[-1] - visits[-2] > remaining
+
+    # the principal variation: the moves to the most visited child at each level
+    def pv(self):
+        tree = self.tree
+        moves = []
+        node = 0
+        while tree.expanded(node):
+            node = tree.first_child[node] + np.argmax(tree.visits[tree.children(node)])
+            move = code_move(tree.move[node])
+            if not move:
+                break
+            moves.append(move)
+        return moves
+
+    # a UCI info line for the search so far. The root value is reported as centipawns
+    # of 400 per factor of ten in odds of winning, i.e. on the Elo scale.
+    def info_line(self):
+        value = self.tree.value_sum[0] / max(1, self.tree.visits[0])
+        score = int(round(400 * np.log10(score_to_odds(value))))
+        pv = self.pv()
+        return 'info depth %d nodes %d nps %d time %d score cp %d pv %s' % (
+            len(pv), self.search_nodes, self.nps(), self.search_time * 1000, score,
+            ' '.join(move.uci() for move in pv))
+
+    # drive a search generator to completion, evaluating the batches it yields with 'model'
+    # (by default our own), and return its result.
+    def run(self, steps, model=None):
+        model = model if model is not None else self.model
+        profiler = self.profiler
+        try:
+            inputs, positions = next(steps)
+            while True:
+                profiler.observe('batch', positions)
+                start = profiler.clock()
+                outputs = evaluate_positions(model, inputs, positions)
+                profiler.lap('evaluate', start)
+                inputs, positions = steps.send(outputs)
+        except StopIteration as stop:
+            return stop.value
+
+    # Generator running playouts from the root, self.iterations of them or as many as the
+    # go parameters in 'limits' allow (see SearchControl), in rounds of self.leaf_batch.
+    def playouts(self, limits=None, info=None):
+        control = SearchControl(self, limits, info)
+        done = 0
+        while not control.should_stop(done):
+            n = min(self.leaf_batch, control.max_playouts - done)
+            done += yield from self.playout_round(self.board, n)
+        control.finish(done)
+
+    # Run playouts in self.search_threads threads at once. Each thread runs rounds on its
+    # own copy of the board, and all share the tree, guarded by one lock, and an Evaluator
+    # that batches their leaves together. The calling thread waits on a condition of the
+    # lock, which the search threads notify after each round, and wakes up at least every
+    # STOP_CHECK_INTERVAL to check the deadline and stop_search. An exception in a search
+    # thread stops the search and is raised again here.
+    def threaded_playouts(self, limits=None, info=None):
+        if self.evaluator is None:
+            self.evaluator = Evaluator(self.model, self.eval_batch, self.eval_latency / 1000.0,
+                                       self.profiler)
+        control = SearchControl(self, limits, info)
+        lock = threading.Lock()
+        progress = threading.Condition(lock)
+        stop = threading.Event()
+        counts = {'claimed': 0, 'done': 0}
+        errors = []
+
+        def search_thread():
+            board = self.board.copy()
+            try:
+                while not stop.is_set():
+                    with lock:
+                        n = min(self.leaf_batch, control.max_playouts - counts['claimed'])
+                        counts['claimed'] += max(0, n)
+                    if n <= 0:
+                        break
+                    n = self.run(self.playout_round(board, n, lock), self.evaluator)
+                    with progress:
+                        counts['done'] += n
+                        progress.notify()
+            except BaseException as e:
+                with progress:
+                    errors.append(e)
+                    progress.notify()
+
+        threads = [threading.Thread(target=search_thread) for _ in range(self.search_threads)]
+        for thread in threads:
+            thread.start()
+        with progress:
+            while not errors and not control.should_stop(counts['done']):
+                progress.wait(STOP_CHECK_INTERVAL)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        control.finish(counts['done'])
+
+    # Generator running one round of n playouts on 'board', returning n. It selects n
+    # leaves, applying virtual loss along the path to each one so that the following
+    # selections are steered to different leaves. It then yields the model inputs of all
+    # leaves needing evaluation as a single batch, together with the number of positions
+    # in it, and expects to be sent back the (value, policy) outputs of the model. Leaves whose position is in the evaluation
+    # cache, or repeats that of another leaf in the round, are not sent to the model, and
+    # the others are sent in the reflections chosen by averages_reflections. Virtual loss is
+    # undone before the leaves are expanded and backpropagated. A leaf selected twice is
+    # only expanded once, but counts towards the playouts.
+    #
+    # Selection pushes moves onto the board and everything needed from a leaf position is
+    # gathered before popping them again, so the board is back at the root whenever the
+    # generator yields or returns.
+    #
+    # With a lock the tree is shared with other threads, and the lock is held except while
+    # waiting for the model. Virtual loss then stays in place during the wait, to steer the
+    # other threads away from these leaves, and is undone by subtracting it again, since
+    # the other threads may have updated the same nodes in the meantime. Another thread may
+    # also have selected the same leaf, so its visits and value sum can include that
+    # thread's virtual loss when it is expanded here. Backpropagation therefore takes the
+    # leaf's value as evaluated rather than reading it back from the tree, and nodes keep
+    # track of their outstanding virtual loss (see Tree) wherever their value is set outright.
+    def playout_round(self, board, n, lock=None):
+        with held(lock):
+            leaves = []
+            undo = []
+            evaluations = {}
+            rows = {}
+            used = 0
+            inputs = np.empty((4 * n, 17, 8, 8), dtype=np.float32)
+            profiler = self.profiler
+            start = profiler.clock()
+            for _ in range(n):
+                stack, node = self.select(board)
+                self.apply_virtual_loss(stack[1:] + [node], undo)
+                start = profiler.lap('select', start)
+                if self.check_terminal(board, node):
+                    leaves.append((stack, node, None, None, False))
+                else:
+                    key = chess.polyglot.zobrist_hash(board)
+                    moves = list(board.legal_moves)
+                    claim_draw = board.halfmove_clock >= 8 and board.can_claim_draw()
+                    leaves.append((stack, node, key, moves, claim_draw))
+                    if key not in evaluations and key not in rows:
+                        averaged = self.averages_reflections(stack)
+                        entry = self.cache.get((key, averaged))
+                        if entry is not None:
+                            evaluations[key] = entry
+                        else:
+                            start = profiler.lap('board', start)
+                            reflections = (ALL_REFLECTIONS if averaged else
+                                           np.random.randint(4, size=1))
+                            encode_board(board, inputs[used:used + 4])
+                            if len(reflections) == 1:
+                                inputs[used] = inputs[used + reflections[0]]
+                            rows[key] = (used, reflections, moves)
+                            used += len(reflections)
+                            start = profiler.lap('encode', start)
+                for _ in stack:
+                    board.pop()
+                profiler.count('depth', len(stack))
+                start = profiler.lap('board', start)
+            profiler.count('playouts', n)
+            profiler.count('evaluated', len(rows))
+            profiler.count('rows', used)
+            if lock is None:
+                for node, visits, value_sum in reversed(undo):
+                    self.tree.visits[node], self.tree.value_sum[node] = visits, value_sum
+                    self.tree.virtual_loss[node] -= self.virtual_loss
+            if rows:
+                with released(lock):
+                    value, policy = yield inputs[:used], len(rows)
+                start = profiler.clock()
+                for key, (i, reflections, moves) in rows.items():
+                    end = i + len(reflections)
+                    evaluations[key] = self.evaluation(moves, value[i:end], policy[i:end],
+                                                       reflections)
+                    averaged = len(reflections) == len(ALL_REFLECTIONS)
+                    self.cache.put((key, averaged), evaluations[key])
+                profiler.lap('priors', start)
+            start = profiler.clock()
+            if lock is not None:
+                for node, _, _ in undo:
+                    self.tree.visits[node] -= self.virtual_loss
+                    self.tree.value_sum[node] -= self.virtual_loss
+                    self.tree.virtual_loss[node] -= self.virtual_loss
+            for stack, node, key, moves, claim_draw in leaves:
+                if key is None:
+                    self.expand_terminal(node)
+                    value = self.tree.result[node]
+                    profiler.count('terminal')
+                elif not self.tree.expanded(node):
+                    value = evaluations[key][0]
+                    self.expand(node, moves, claim_draw, *evaluations[key])
+                else:
+                    profiler.count('duplicate')
+                    continue
+                start = profiler.lap('expand', start)
+                self.backprop(stack, value)
+                start = profiler.lap('backprop', start)
+            return n
+
+    # descend from the root by priority to a leaf, pushing the moves on the way onto
+    # 'board', and return the stack of nodes above the leaf and the leaf node. Expanded
+    # nodes are never terminal, so no game over checks are needed on the way down.
+    def select(self, board):
+        tree = self.tree
+        stack = []
+        node = 0
+        while tree.expanded(node):
+            stack.append(node)
+            child = tree.first_child[node] + np.argmax(self.priorities(node))
+            board.push(code_move(tree.move[child]))
+            node = child
+        return stack, node
+
+    # Whether the unexpanded node whose position is on 'board' is terminal. This is only
+    # worked out on the first visit, when terminal nodes also get their result recorded.
+    def check_terminal(self, board, node):
+        tree = self.tree
+        if tree.terminal[node] == 0:
+            if not is_terminal(board):
+                tree.terminal[node] = -1
+                return False
+            result = board.result()
+            if result == '1-0':
+                tree.result[node] = 1.0 if board.turn else -1.0
+            elif result == '0-1':
+                tree.result[node] = -1.0 if board.turn else 1.0
+            else:
+                tree.result[node] = 0.0
+            tree.terminal[node] = 1
+        return tree.terminal[node] > 0
+
+    # Whether to evaluate a leaf below the nodes 'stack' in all 4 reflections, by
+    # self.symmetry: always ('all'), never ('one'), only for leaves at most
+    # self.symmetry_depth moves below the root ('root'), or whose parent has at most
+    # self.symmetry_visits visits, counting virtual loss ('visits'). Otherwise it is evaluated
+    # in one reflection at random, which costs a quarter of the model evaluation, at the
+    # price of noisier values and priors. Cached evaluations are keyed by this too, so that
+    # a single reflection is never reused where an average of all 4 is wanted.
+    def averages_reflections(self, stack):
+        return (self.symmetry == 'all' or
+                self.symmetry == 'root' and len(stack) <= self.symmetry_depth or
+                self.symmetry == 'visits' and (not stack or
+                                               self.tree.visits[stack[-1]] <= self.symmetry_visits))
+
+    # make each node on a path look like a loss for the player choosing it, recording the
+    # original visits and value sums in 'undo'.
+    def apply_virtual_loss(self, path, undo):
+        tree = self.tree
+        for node in path:
+            undo.append((node, tree.visits[node], tree.value_sum[node]))
+            tree.visits[node] += self.virtual_loss
+            tree.value_sum[node] += self.virtual_loss
+            tree.virtual_loss[node] += self.virtual_loss
+
+    # make a chosen move, keeping the subtree below it
     def make_move(self, move):
         self.board.push(move)
-        if self.root[0] is not None:
-            self.root = self.root[0][move]
+        child = self.tree.find_child(0, move)
+        if child >= 0:
+            self.tree.reroot(child)
         else:
-            self.root = [None, 0, 0.0, 0.0]
+            self.tree.reset()
 
     # the value of the current state for the given player
     def value(self, for_white):
-        self_value = self.root[2] / max(1, self.root[1])
+        self_value = self.tree.value_sum[0] / max(1, self.tree.visits[0])
         white_turn = self.board.turn
         sign = 1 if white_turn == for_white else -1
         return self_value * sign
 
-    def priority(self, node, move):
-        child_node = node[0][move]
-        if child_node[1] > 0:
-            # estimated value of the child position from the perspective of the parent.
-            move_value = -child_node[2] / child_node[1]
-        else:
-            # if we haven't evaluated child yet, estimate its prior value (from the perspective of
-            # the parent) as a little worse than the value of the parent. In principle the best move
-            # should have a value about equal to or a little better than the parent. We do this
-            # instead of letting the prior be zero because when we are disadvantaged we don't want
-            # unevaluated low probability moves to start with higher move_value than evaluated high
-            # probability moves, as this would force too high a branching factor (and conversely
-            # too low a branching factor when advantaged).
+    # the priorities of all children of an expanded node, as an array in child order
+    def priorities(self, node):
+        tree = self.tree
+        start = tree.first_child[node]
+        end = start + tree.num_children[node]
+        visits = tree.visits[start:end]
+        value_sum = tree.value_sum[start:end]
+        # if we haven't evaluated a child yet, estimate its prior value (from the perspective of
+        # the parent) as a little worse than the value of the parent. In principle the best move
+        # should have a value about equal to or a little better than the parent. We do this
+        # instead of letting the prior be zero because when we are disadvantaged we don't want
+        # unevaluated low probability moves to start with higher move_value than evaluated high
+        # probability moves, as this would force too high a branching factor (and conversely
+        # too low a branching factor when advantaged).
+        unvisited_value = 0.0
+        if self.parent_prior_odds_mult > 0 or self.parent_prior_value_diff > 0:
+            parent_value = tree.value_sum[node] / tree.visits[node]
             if self.parent_prior_odds_mult > 0:
-                move_value = odds_to_score(score_to_odds(node[2] / node[1]) * self.parent_prior_odds_mult)
-            elif self.parent_prior_value_diff > 0:
-                move_value = score_to_odds(node[2] / node[1]) - self.parent_prior_value_diff
+                unvisited_value = odds_to_score(score_to_odds(parent_value) * self.parent_prior_odds_mult)
             else:
-                move_value = np.random.random() * 0.0
+                unvisited_value = score_to_odds(parent_value) - self.parent_prior_value_diff
+        # estimated value of each child position from the perspective of the parent.
+        visited = visits > 0
+        move_value = np.where(visited, -value_sum / np.where(visited, visits, 1.0), unvisited_value)
         if self.value_in_log_odds > 0:
             multiplier = min(0.999, max(0.001, self.value_in_log_odds))
             # in the limit as the vilo multiplier approaches zero this transformation has no effect.
@@ -235,34 +900,43 @@ class Engine(object):
             # the vicinity of 0.9.
             move_value = np.log(score_to_odds(move_value * multiplier)) / 2.0 / multiplier
         info_value = (self.exploration / 2.0 *
-                      (((node[1] ** 0.5) / (1 + child_node[1])) ** self.priority_exponent) *
-                      (self.priority_uniform / len(node[0]) + child_node[3]))
+                      (((tree.visits[node] ** 0.5) / (1 + visits)) ** self.priority_exponent) *
+                      (self.priority_uniform / (end - start) + tree.prior[start:end]))
         return move_value + info_value
         
-    def expand(self, state, node):
-        if state.is_game_over() or draw_claimed(state):
-            result = state.result()
-            if result == '1-0':
-                value = 1.0 if state.turn else -1.0
-            elif result == '0-1':
-                value = -1.0 if state.turn else 1.0
-            else:
-                value = 0.0
-            node[1] += 1
-            node[2] = node[1] * value
-        else:
-            value, policy = self.session.run(self.outputs, feed_dict={self.input: to_model_input(state)})
-            node[0] = {}
-            node[1] = 1
-            node[2] = value.mean()
-            for m in state.legal_moves:
-                m_prior = np.mean([policy[i, policy_index(m, i)] for i in range(4)])
-                node[0][m] = [None, 0, 0.0, m_prior]
-            if state.halfmove_clock >= 8 and state.can_claim_draw():
-                node[0][chess.Move.null()] = [None, 1, 0.0, 0.10]
-
-    def backprop(self, stack, node):
-        val = node[2] / node[1]
+    # Expansion adds to the visits and value sum of the leaf rather than setting them, so
+    # that virtual loss other threads may have on it is undone correctly.
+    def expand_terminal(self, node):
+        self.tree.visits[node] += 1
+        self.tree.value_sum[node] += self.tree.result[node]
+
+    # the averaged value and the prior of each of the legal moves of a state, given the
+    # model outputs for the given reflections of it
+    def evaluation(self, moves, value, policy, reflections=ALL_REFLECTIONS):
+        from_squares, to_squares = move_squares(moves)
+        rows = np.arange(len(reflections)).reshape(-1, 1)
+        priors = policy[rows, POLICY_INDEX[np.reshape(reflections, (-1, 1)), from_squares, to_squares]]
+        return value.mean(), priors.mean(axis=0, dtype=np.float32)
+
+    # expand a non-terminal leaf given its legal moves, whether a draw can be claimed, its
+    # value and the priors of its legal moves
+    def expand(self, node, moves, claim_draw, value, priors):
+        if node == 0 and self.root_book is not None:
+            priors = self.mix_book_priors(moves, priors, self.root_book)
+            self.root_book = None
+        codes = [move_code(m) for m in moves]
+        if claim_draw:
+            codes.append(move_code(chess.Move.null()))
+            priors = np.append(priors, np.float32(0.10))
+        start = self.tree.expand(node, codes, priors)
+        self.tree.visits[node] += 1
+        self.tree.value_sum[node] += value
+        if claim_draw:
+            self.tree.visits[start + len(moves)] = 1
+
+    # backpropagate the value of a newly visited leaf, for the player to move at the leaf,
+    # to the nodes 'stack' above it
+    def backprop(self, stack, val):
         if self.backprop_win_loss and val == 1.0:
             self.backprop_win(stack, len(stack))
         elif self.backprop_win_loss and val == -1.0:
@@ -271,36 +945,42 @@ class Engine(object):
             self.backprop_norm(stack, len(stack), val)
             
     def backprop_norm(self, stack, result_level, val):
+        tree = self.tree
         for i in range(result_level, 0, -1):
             j = i - 1
-            if stack[j][2] == stack[j][1]:
+            if tree.value_sum[stack[j]] == tree.visits[stack[j]]:
                 # if we were searching non-winning moves below an already known won state,
                 # treat it during backprop like it's won.
                 return self.backprop_loss(stack, j + 1)
-            stack[j][2] += val * ((-1) ** (result_level - j))
-            stack[j][1] += 1
+            tree.value_sum[stack[j]] += val * ((-1) ** (result_level - j))
+            tree.visits[stack[j]] += 1
 
     def backprop_loss(self, stack, loss_level):
+        tree = self.tree
         parent = loss_level - 1
-        stack[parent][1] += 1
-        stack[parent][2] = stack[parent][1]
+        tree.visits[stack[parent]] += 1
+        tree.value_sum[stack[parent]] = tree.visits[stack[parent]]
         if parent > 0:
             self.backprop_win(stack, parent)
 
     def backprop_win(self, stack, win_level):
+        tree = self.tree
         parent = win_level - 1
-        stack[parent][1] += 1
-        all_won = True
-        for move, node in stack[parent][0].items():
-            if node[1] == 0 or node[1] != node[2]:
-                all_won = False
-                break
+        tree.visits[stack[parent]] += 1
+        children = tree.children(stack[parent])
+        visits = tree.visits[children]
+        # virtual loss adds as much to visits as to value sums, so it does not change
+        # whether they are equal, but it does hide unvisited children
+        all_won = np.all((visits != tree.virtual_loss[children]) &
+                         (visits == tree.value_sum[children]))
         if all_won:
-            stack[parent][2] = -stack[parent][1]
+            # a lost value of -visits once any virtual loss on the node is undone
+            node = stack[parent]
+            tree.value_sum[node] = 2 * tree.virtual_loss[node] - tree.visits[node]
             if parent > 0:
                 self.backprop_loss(stack, parent)
         else:
-            stack[parent][2] -= 1.0
+            tree.value_sum[stack[parent]] -= 1.0
             if parent > 0:
                 self.backprop_norm(stack, parent, -1.0)
 
@@ -309,36 +989,47 @@ class Engine(object):
         p = max(0.0, min(1.0, n / self.ramp))
         return p * self.temperature + (1.0 - p) * min(1.0, self.temperature * 10)
         
+    # the children of the root and their moves, ordered by uci
+    def root_children(self):
+        children = self.tree.children(0)
+        moves = [code_move(code) for code in self.tree.move[children]]
+        order = sorted(range(len(moves)), key=lambda i: moves[i].uci())
+        return children[order], [moves[i] for i in order]
+
     def pick_move_by_count(self):
-        nodes = self.root[0]
-        moves = [move for move in sorted(nodes.keys(), key=lambda x: x.uci())]
-        counts = np.array([nodes[move][1] for move in moves])
-        values = np.array([-nodes[move][2] for move in moves]) / np.maximum(1, counts)
-        priors = np.array([nodes[move][3] for move in moves])
+        tree = self.tree
+        children, moves = self.root_children()
+        counts = tree.visits[children]
+        values = -tree.value_sum[children] / np.maximum(1, counts)
+        priors = tree.prior[children]
         evals = counts + self.policy_add_value_and_prior * (values + priors)
         if self.take_or_avoid_knowns:
             evals += 10000 * (values == 1.0)
             evals -= 10000 * (values == -1.0)
             evals = np.maximum(0.000001, evals)
+        if evals.sum() <= 0:
+            # no child was visited, as when a timed search ends right after expanding the root
+            evals = priors.astype(np.float64)
         evals = evals / evals.sum()
         evals = evals ** (1 / self.effective_temperature())
         evals = evals / evals.sum()
         if not self.quiet:
-            print('Value: %8.5f' % (self.root[2] / self.root[1]))
+            priorities = self.priorities(0)[children - tree.first_child[0]]
+            print('Value: %8.5f' % (tree.value_sum[0] / tree.visits[0]))
             for i in range(len(moves)):
                 print('%s:\t%5.3f  (%4d %8.4f %7.4f) %8.5f' % (moves[i].uci(), evals[i],
-                                                               nodes[moves[i]][1],
-                                                               nodes[moves[i]][2]/max(1, nodes[moves[i]][1]),
-                                                               nodes[moves[i]][3],
-                                                               self.priority(self.root, moves[i])))
+                                                               counts[i],
+                                                               -values[i],
+                                                               priors[i],
+                                                               priorities[i]))
         which = np.random.choice(len(moves), p=evals)
         return moves[which]
 
     def pick_move_by_value(self):
-        nodes = self.root[0]
-        moves = [move for move in sorted(nodes.keys(), key=lambda x: x.uci())]
-        counts = np.array([nodes[move][1] for move in moves])
-        values = np.array([-nodes[move][2] for move in moves]) / np.maximum(1, counts)
+        tree = self.tree
+        children, moves = self.root_children()
+        counts = tree.visits[children].copy()
+        values = -tree.value_sum[children] / np.maximum(1, counts)
         # convert score to probability:  0 < p < 1
         probs = (values * 0.9999 + 1.0) / 2.0
         # for known values force very high precision
@@ -353,40 +1044,253 @@ class Engine(object):
         # add a random component based on temperature
         randoms = np.random.beta(alpha, beta) * self.temperature
         if not self.quiet:
-            priorities = [self.priority(self.root, move) for move in moves]
+            priorities = self.priorities(0)[children - tree.first_child[0]]
             for i in range(len(moves)):
                 print('%s:\t%5.3f  (%4d %8.4f %7.4f) %8.5f' % (moves[i].uci(), quantiles[i],
-                                                               nodes[moves[i]][1],
-                                                               nodes[moves[i]][2]/max(1, nodes[moves[i]][1]),
-                                                               nodes[moves[i]][3], priorities[i]))
+                                                               tree.visits[children[i]],
+                                                               -values[i],
+                                                               tree.prior[children[i]], priorities[i]))
         which = np.argmax(quantiles + randoms)
         return moves[which]
 
 
+# Play num_games self-play games, with up to 'concurrency' games in progress at once. Each
+# game has its own engine, tree and board, and all share one model and evaluation cache.
+# Whenever every game is waiting on the model, their pending leaf evaluations are
+# concatenated into a single batch so the model sees concurrency times larger batches than
+# one engine alone. 'on_game', if given, is called with the result of each game once its
+# training data has been written to f.
+def play_concurrent(model, args, num_games, concurrency, f, on_game=None):
+    games = []
+    started = 0
+    cache = None
+    for _ in range(min(concurrency, num_games)):
+        engine = Engine(model, args, quiet=True, cache=cache)
+        cache = engine.cache
+        engine.start()
+        games.append([engine, engine.search_steps(), None])
+        started += 1
+
+    while games:
+        # advance each game until it needs the model, finishing games and starting new ones
+        waiting = []
+        for game in games:
+            engine, steps, outputs = game
+            while True:
+                try:
+                    game[2] = next(steps) if outputs is None else steps.send(outputs)
+                    waiting.append(game)
+                    break
+                except StopIteration:
+                    outputs = None
+                    board = engine.board
+                    if board.is_game_over() or draw_claimed(board):
+                        result = '1/2-1/2' if draw_claimed(board) else board.result()
+                        print('Outcome: %s' % result)
+                        engine.save_training_data(f, result, len(board.move_stack))
+                        if on_game is not None:
+                            on_game(result)
+                        if started == num_games:
+                            break
+                        engine.start()
+                        started += 1
+                    steps = engine.search_steps()
+                    game[1] = steps
+        games = waiting
+        if not games:
+            break
+
+        # evaluate all pending leaves together and hand each game its share of the outputs
+        inputs = np.concatenate([game[2][0] for game in games])
+        value, policy = evaluate_positions(model, inputs, sum(game[2][1] for game in games))
+        start = 0
+        for game in games:
+            end = start + len(game[2][0])
+            game[2] = (value[start:end], policy[start:end])
+            start = end
+
+
+# the backends whose models may be loaded before forking self-play workers (see play_parallel)
+FORK_SAFE_BACKENDS = ['numpy', 'tflite', 'server']
+
+
+# Self-play worker process. Each game's training data is sent to the parent as a message
+# (worker, result, data) on 'results', followed by (worker, None, None) when done. 'model'
+# is a model when the worker was forked after loading it, or else a model path.
+def play_worker(model, args, num_games, concurrency, seed, worker, results):
+    np.random.seed(seed)
+    if isinstance(model, str):
+        model = load_model(model, args)
+    buf = io.BytesIO()
+
+    def send(result):
+        results.put((worker, result, buf.getvalue()))
+        buf.seek(0)
+        buf.truncate()
+
+    play_concurrent(model, args, num_games, concurrency, buf, on_game=send)
+    results.put((worker, None, None))
+
+
+# Play num_games self-play games in num_workers processes, each with its own random seed
+# derived from 'seed'. Where the platform can fork and the backend is in FORK_SAFE_BACKENDS,
+# the model is loaded once and the workers are forked from this process; otherwise each
+# worker loads the model itself. A TensorFlow session is not safe to use in a forked
+# child, so tf models are always loaded by the workers. The games are written to
+# data.chess2.<millis>.work files, each renamed to .done once it holds games_per_file
+# games, and games per hour of each worker are reported as they go.
+def play_parallel(model_path, args, num_games, concurrency, num_workers, games_per_file, seed):
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context('spawn')
+    backend = args['back'] if 'back' in args else 'tf'
+    if context.get_start_method() == 'fork' and backend in FORK_SAFE_BACKENDS:
+        model = load_model(model_path, args)
+    else:
+        model = model_path
+    results = context.Queue()
+    workers = []
+    for i in range(num_workers):
+        worker_games = num_games // num_workers + (1 if i < num_games % num_workers else 0)
+        workers.append(context.Process(target=play_worker, daemon=True,
+                                       args=(model, args, worker_games, concurrency, seed + i,
+                                             i, results)))
+    start = time.time()
+    for worker in workers:
+        worker.start()
+
+    games = [0] * num_workers
+    running = num_workers
+    f = None
+    logfile = None
+    in_file = 0
+    while running > 0:
+        try:
+            worker, result, data = results.get(timeout=10)
+        except queue.Empty:
+            if any(w.is_alive() for w in workers):
+                continue
+            print('all workers exited')
+            break
+        if result is None:
+            running -= 1
+            continue
+        if f is None:
+            logfile = 'data.chess2.%d' % int(time.time() * 1000)
+            f = open('%s.work' % logfile, 'wb')
+        f.write(data)
+        in_file += 1
+        if in_file == games_per_file:
+            f.close()
+            os.rename('%s.work' % logfile, '%s.done' % logfile)
+            f = None
+            in_file = 0
+        games[worker] += 1
+        hours = (time.time() - start) / 3600.0
+        print('worker %d: %s, %d games, %.1f games/hour (all workers: %d games, %.1f games/hour)' %
+              (worker, result, games[worker], games[worker] / hours, sum(games), sum(games) / hours))
+    if f is not None:
+        f.close()
+        os.rename('%s.work' % logfile, '%s.done' % logfile)
+    for worker in workers:
+        worker.join()
+
+
+GO_PARAMS = ['wtime', 'btime', 'winc', 'binc', 'movetime', 'nodes', 'movestogo']
+GO_FLAGS = ['infinite', 'ponder']
+INFO_INTERVAL = 1.0
+STOP_CHECK_INTERVAL = 0.01
+
+
+# the parameters of a UCI go command, e.g. go wtime 60000 btime 60000 winc 1000, with
+# flags like ponder mapped to True
+def parse_go(toks):
+    limits = {}
+    for i in range(len(toks)):
+        if toks[i] in GO_PARAMS and i + 1 < len(toks):
+            limits[toks[i]] = int(toks[i + 1])
+        elif toks[i] in GO_FLAGS:
+            limits[toks[i]] = True
+    return limits
+
+
+# engine args from e.g. iter=800,temp=0.1,back=numpy. Values are python literals where they
+# parse as one, and otherwise strings, so paths and names need no quotes.
 def argdict(argstr):
-    dictfmt = ['"%s": %s' % tuple(argval.split('=')) for argval in argstr.split(",")]
-    return literal_eval('{ %s }' % ','.join(dictfmt))
+    args = {}
+    for argval in argstr.split(','):
+        name, value = argval.split('=', 1)
+        try:
+            args[name] = literal_eval(value)
+        except (ValueError, SyntaxError):
+            args[name] = value
+    return args
 
 
+# Searches run in a background thread, so that stop, isready and ponderhit are handled
+# while searching. A go ponder search thinks on the opponent's time about the position
+# after the expected reply, and on ponderhit continues as a timed search on the same tree.
 def uci_engine_loop(engine):
+    _lock = threading.Lock()
+    _search = []
+
+    def _send(line):
+        with _lock:
+            print(line, flush=True)
+
+    def _search_and_move(limits):
+        pv = []
+
+        # the last call comes from SearchControl.finish, before the move is made, so the pv
+        # kept then starts with our move and continues with the reply to ponder on
+        def info():
+            pv[:] = engine.pv()
+            _send(engine.info_line())
+
+        move = engine.search(limits, info=info)
+        if engine.last_profile is not None:
+            _send('info string profile %s' % json.dumps(engine.last_profile))
+        ponder = ' ponder %s' % pv[1].uci() if len(pv) > 1 and pv[0] == move else ''
+        _send('bestmove %s%s' % (move.uci(), ponder))
+
+    # end any search in progress, waiting for its bestmove
+    def _finish():
+        if _search:
+            engine.stop_search.set()
+            _search.pop().join()
 
     def uci(_):
-        print('id name yace')
-        print('uciok')
+        _send('id name yace')
+        _send('option name Ponder type check default false')
+        _send('uciok')
 
     def isready(_):
-        print('readyok')
+        _send('readyok')
 
     def ucinewgame(_):
+        _finish()
         engine.start(chess.STARTING_FEN)
 
     def position(toks):
+        _finish()
         engine.position(toks)
 
-    def go(_):
-        print('bestmove %s' % engine.search().uci())
+    def go(toks):
+        _finish()
+        engine.stop_search.clear()
+        engine.ponder_hit.clear()
+        _search.append(threading.Thread(target=_search_and_move, args=(parse_go(toks),)))
+        _search[0].start()
+
+    def ponderhit(_):
+        engine.ponder_hit.set()
+
+    def stop(_):
+        _finish()
 
     def quit(_):
+        _finish()
         sys.exit(0)
 
     while True:
@@ -398,7 +1302,7 @@ def uci_engine_loop(engine):
 
 
 def main(argv):
-    opts, _ = getopt.getopt(argv, 'a:m:n:uq', [])
+    opts, _ = getopt.getopt(argv, 'a:g:j:m:n:r:s:uq', [])
     opts = dict(opts)
 
     print(opts)
@@ -406,22 +1310,32 @@ def main(argv):
     args = argdict(opts['-a']) if '-a' in opts else {}
     model = opts['-m'] if '-m' in opts else ''
     num_games = int(opts['-n']) if '-n' in opts else 10
+    concurrency = int(opts['-g']) if '-g' in opts else 1
+    num_workers = int(opts['-j']) if '-j' in opts else 1
+    games_per_file = int(opts['-r']) if '-r' in opts else num_games
+    seed = int(opts['-s']) if '-s' in opts else int(time.time())
     uci = '-u' in opts
     quiet = opts['-q'].lower() in ['true', '1'] if '-q' in opts else uci
 
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
-    K.set_session(tf.Session(config=config))
-
     if uci:
         uci_engine_loop(Engine(model, args, quiet=quiet))
 
     print('%s\nmodel: %s' % ('#' * 40, model))
     print('args: %s\n%s\n' % (args, '#' * 40))
     
-    engine = Engine(model, args, quiet=quiet)
+    if num_workers > 1:
+        play_parallel(model, args, num_games, concurrency, num_workers, games_per_file, seed)
+        return
 
     logfile = 'data.chess2.%d' % int(time.time() * 1000)
+    if concurrency > 1:
+        with open('%s.work' % logfile, 'wb') as f:
+            play_concurrent(load_model(model, args), args, num_games, concurrency, f)
+        os.rename('%s.work' % logfile, '%s.done' % logfile)
+        return
+
+    engine = Engine(model, args, quiet=quiet)
+
     with open('%s.work' % logfile, 'wb') as f:
         for _ in range(num_games):
             engine.start()
@@ -0,0 +1,33 @@
+import numpy as np
+
+#
+# Policy index tables shared by the engine and the loader. The policy index of a move is
+# 64 * from_square + to_square, with squares numbered as in python-chess (a1 = 0, h8 = 63).
+# The model sees each position in 4 reflections r = flip_left_right + 2 * reverse_sides,
+# and reflection r maps square s to s ^ REFLECTION_MASKS[r], so:
+#
+#   POLICY_INDEX[r, from_square, to_square]  policy index of a move in reflection r
+#   FLIP_POLICY[r, index]                    policy index in reflection r of the move with
+#                                            policy index 'index' in the original position
+#
+# FLIP_POLICY is just POLICY_INDEX with the squares flattened to a policy index.
+#
+
+REFLECTION_MASKS = np.array([0, 7, 56, 63])
+
+
+def _policy_index():
+    squares = np.arange(64)
+    masks = REFLECTION_MASKS.reshape(4, 1, 1)
+    return (squares.reshape(1, 64, 1) ^ masks) * 64 + (squares.reshape(1, 1, 64) ^ masks)
+
+
+POLICY_INDEX = _policy_index()
+FLIP_POLICY = POLICY_INDEX.reshape(4, 64 * 64)
+
+
+# the from and to squares of a list of moves, as arrays to index POLICY_INDEX with
+def move_squares(moves):
+    from_squares = np.array([m.from_square for m in moves], dtype=np.int64)
+    to_squares = np.array([m.to_square for m in moves], dtype=np.int64)
+    return from_squares, to_squares
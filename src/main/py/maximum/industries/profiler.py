@@ -0,0 +1,81 @@
+import collections
+import json
+import time
+
+#
+# Opt-in instrumentation of Engine.search. Hot paths time themselves in laps:
+#
+#   start = profiler.clock()
+#   ...
+#   start = profiler.lap('select', start)
+#
+# which adds the time since 'start' to the 'select' timer and returns the time to start the
+# next lap from. Counters and power of two histograms are kept the same way. At the end of
+# each search report() returns everything recorded since the last report, together with the
+# search statistics it is given, appends it as a line of JSON to the log file if there is
+# one, and starts over.
+#
+# Engines that are not profiling use a NullProfiler, whose methods do nothing, so the only
+# cost of the instrumentation is a few empty method calls per playout. Updates from several
+# search threads are not locked, so under multi-threaded search the figures are
+# approximate.
+#
+
+
+class Profiler(object):
+    enabled = True
+
+    def __init__(self, log_path=None):
+        self.log = open(log_path, 'a') if log_path else None
+        self.reset()
+
+    def reset(self):
+        self.timers = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(lambda: collections.defaultdict(int))
+
+    def clock(self):
+        return time.perf_counter()
+
+    def lap(self, name, start):
+        now = time.perf_counter()
+        self.timers[name] += now - start
+        return now
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    # count 'value' in the bucket of the smallest power of two at least as large
+    def observe(self, name, value):
+        self.histograms[name][1 << max(0, int(value) - 1).bit_length()] += 1
+
+    def report(self, **stats):
+        record = dict(stats)
+        record['timers'] = {name: round(seconds, 6) for name, seconds in sorted(self.timers.items())}
+        record['counters'] = dict(sorted(self.counters.items()))
+        record['histograms'] = {name: {str(bucket): count for bucket, count in sorted(buckets.items())}
+                                for name, buckets in sorted(self.histograms.items())}
+        if self.log is not None:
+            self.log.write(json.dumps(record) + '\n')
+            self.log.flush()
+        self.reset()
+        return record
+
+
+class NullProfiler(object):
+    enabled = False
+
+    def clock(self):
+        return 0.0
+
+    def lap(self, name, start):
+        return 0.0
+
+    def count(self, name, n=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def report(self, **stats):
+        return None
@@ -0,0 +1,154 @@
+import getopt, sys, time
+import numpy as np
+
+sys.path.append('.')
+sys.path.append('src/main/py')
+import maximum.industries.loader as loader
+
+#
+# Post-training quantization of exported models for CPU self-play. The SavedModel written by
+# modeldef.save_model is converted to TensorFlow Lite in one of these forms:
+#
+#   int8     weights and activations in int8, with per-channel scales for the convolution
+#            kernels. Activation ranges are calibrated by running the float model on a
+#            sample of training positions from the loader. Inputs and outputs stay float32.
+#   float16  weights stored in float16, computed in float32. Half the size, same accuracy.
+#   float32  no quantization, as a baseline for the others.
+#
+# Engines run the converted model with -a back=tflite (see play.load_model). Conversion needs
+# TensorFlow, but TFLiteModel only needs the tflite_runtime interpreter where it is installed.
+#
+
+def tflite_name(model_path, kind):
+    return '%s.%s.tflite' % (model_path.rstrip('/'), kind)
+
+
+# the SavedModel at export_dir converted to a TFLite flatbuffer of the given kind, where int8
+# models are calibrated on 'calibration_inputs', a batch of model inputs. The SavedModel has
+# no signatures, so it is converted from a session with the graph's input and output nodes.
+def convert(export_dir, kind, calibration_inputs=None):
+    import tensorflow as tf
+    with tf.Graph().as_default() as graph:
+        with tf.Session() as sess:
+            tf.saved_model.loader.load(sess, [tf.saved_model.tag_constants.SERVING], export_dir)
+            converter = tf.lite.TFLiteConverter.from_session(
+                sess, [graph.get_tensor_by_name('input:0')],
+                [graph.get_tensor_by_name(name) for name in ['value/Tanh:0', 'policy/Softmax:0']])
+            return converter_options(tf, converter, kind, calibration_inputs).convert()
+
+
+def converter_options(tf, converter, kind, calibration_inputs):
+    if kind == 'int8':
+        def representative_data():
+            for x in calibration_inputs:
+                yield [x[np.newaxis].astype(np.float32)]
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = tf.lite.RepresentativeDataset(representative_data)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif kind == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif kind != 'float32':
+        raise Exception('unknown quantization %s' % kind)
+    return converter
+
+
+class TFLiteModel(object):
+
+    def __init__(self, path):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=path)
+        self.input = self.interpreter.get_input_details()[0]['index']
+        # the value output has a single column and the policy output 4096
+        outputs = sorted(self.interpreter.get_output_details(), key=lambda d: d['shape'][-1])
+        self.outputs = [d['index'] for d in outputs]
+        self.batch_size = None
+
+    # returns (value, policy) for a batch of model inputs, like play.Model. The interpreter
+    # is resized whenever the batch size changes, which is rare within a search.
+    def evaluate(self, inputs):
+        inputs = np.asarray(inputs, dtype=np.float32)
+        if len(inputs) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input, inputs.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(inputs)
+        self.interpreter.set_tensor(self.input, inputs)
+        self.interpreter.invoke()
+        return [self.interpreter.get_tensor(i).copy() for i in self.outputs]
+
+
+def evaluate_all(model, inputs, batch_size):
+    results = [model.evaluate(inputs[i:i + batch_size]) for i in range(0, len(inputs), batch_size)]
+    return (np.concatenate([value for value, _ in results]),
+            np.concatenate([policy for _, policy in results]))
+
+
+# Agreement of a model with a reference model on the same inputs, evaluated batch_size rows
+# at a time as an engine would, and the rows per second of each.
+def agreement(reference, model, inputs, batch_size):
+    start = time.time()
+    expected_value, expected_policy = evaluate_all(reference, inputs, batch_size)
+    reference_time = time.time() - start
+    start = time.time()
+    value, policy = evaluate_all(model, inputs, batch_size)
+    model_time = time.time() - start
+    value_error = np.abs(value - expected_value)
+    return {
+        'value_mean_abs': float(value_error.mean()),
+        'value_max_abs': float(value_error.max()),
+        'value_same_sign': float(np.mean(np.sign(value) == np.sign(expected_value))),
+        'policy_top1': float(np.mean(policy.argmax(axis=1) == expected_policy.argmax(axis=1))),
+        'policy_total_variation': float(0.5 * np.abs(policy - expected_policy).sum(axis=1).mean()),
+        'reference_rows_per_second': len(inputs) / max(reference_time, 1e-9),
+        'rows_per_second': len(inputs) / max(model_time, 1e-9),
+    }
+
+
+def main(argv):
+    opts, _ = getopt.getopt(argv, 'hm:d:t:c:n:b:f:', ['data='])
+    opts = dict(opts)
+    if '-h' in opts or '-m' not in opts:
+        print('quantize.py [-h] // help')
+        print('            -m <model> // SavedModel directory, e.g., tfmodels/r14/1549380964')
+        print('            [-d|--data <data>] // e.g., data/shuffled')
+        print('            [-t int8|float16|float32] // quantization, default int8')
+        print('            [-f <num_files>] // data files to sample positions from')
+        print('            [-c <num_calibration>] // positions to calibrate int8 ranges on')
+        print('            [-n <num_positions>] // positions to compare with the float model on')
+        print('            [-b <batch_size>] // rows per evaluation, 4 per leaf')
+        exit()
+
+    model_path = opts['-m']
+    data_pattern = opts['-d'] if '-d' in opts else opts.get('--data', 'shuffled')
+    kind = opts['-t'] if '-t' in opts else 'int8'
+    num_files = int(opts['-f']) if '-f' in opts else 6
+    num_calibration = int(opts['-c']) if '-c' in opts else 500
+    num_positions = int(opts['-n']) if '-n' in opts else 2000
+    batch_size = int(opts['-b']) if '-b' in opts else 4
+
+    # calibrate on one sample of positions and compare on another
+    rng = np.random.default_rng(0)
+    x_input, _, _ = loader.load_balance_transform('%s.*.done' % data_pattern, num_files, rng=rng)
+    rows = rng.permutation(len(x_input))
+    calibration_inputs = x_input[rows[:num_calibration]]
+    inputs = x_input[rows[num_calibration:num_calibration + num_positions]]
+    print('%d calibration and %d comparison positions' % (len(calibration_inputs), len(inputs)))
+
+    path = tflite_name(model_path, kind)
+    with open(path, 'wb') as f:
+        f.write(convert(model_path, kind, calibration_inputs))
+    print('wrote %s' % path)
+
+    from maximum.industries.play import Model
+    results = agreement(Model(model_path), TFLiteModel(path), inputs, batch_size)
+    for name, value in results.items():
+        print('%-28s %10.4f' % (name, value))
+    print('speedup %.2fx' % (results['rows_per_second'] / results['reference_rows_per_second']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
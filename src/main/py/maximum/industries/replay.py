@@ -0,0 +1,96 @@
+import glob, os
+import numpy as np
+import maximum.industries.columnar as columnar
+import maximum.industries.loader as loader
+
+#
+# A fixed-capacity replay buffer of training positions. Data files are ingested once
+# each, as they appear, and their balanced positions are written into a ring, evicting the
+# oldest positions when full. Training batches are then sampled uniformly from the ring,
+# so the cost of an epoch does not depend on how many data files have accumulated.
+#
+# Tree search results are stored padded to MAX_MOVES entries per position (chess has at
+# most 218 legal moves) so that positions can be overwritten in place.
+#
+
+MAX_MOVES = 256
+
+
+class ReplayBuffer(object):
+
+    def __init__(self, capacity, rng=None):
+        self.capacity = capacity
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.board = np.zeros((capacity, 64), dtype=np.uint8)
+        self.player = np.zeros(capacity, dtype=np.int8)
+        self.outcome = np.zeros(capacity, dtype=np.int8)
+        self.game_length = np.zeros(capacity, dtype=np.int32)
+        self.policy_count = np.zeros(capacity, dtype=np.int16)
+        self.policy_index = np.zeros((capacity, MAX_MOVES), dtype=np.uint16)
+        self.policy_prob = np.zeros((capacity, MAX_MOVES), dtype=np.float32)
+        self.size = 0
+        self.next = 0
+        self.seen = set()
+
+    # write the rows of a Columns into the ring, overwriting the oldest positions
+    def add(self, cols):
+        k = len(cols.board)
+        skip = max(0, k - self.capacity)
+        rows = np.arange(skip, k)
+        slots = (self.next + np.arange(len(rows))) % self.capacity
+        counts = np.minimum(np.diff(cols.offset)[rows], MAX_MOVES)
+        self.board[slots] = cols.board[rows]
+        self.player[slots] = cols.player[rows]
+        self.outcome[slots] = cols.outcome[rows]
+        self.game_length[slots] = cols.game_length[rows]
+        self.policy_count[slots] = counts
+        self.policy_index[slots] = 0
+        self.policy_prob[slots] = 0.0
+        entry_row = np.repeat(np.arange(len(rows)), counts)
+        entry_pos = np.arange(len(entry_row)) - np.repeat(np.cumsum(counts) - counts, counts)
+        entries = cols.offset[rows][entry_row] + entry_pos
+        self.policy_index[slots[entry_row], entry_pos] = cols.index[entries]
+        self.policy_prob[slots[entry_row], entry_pos] = cols.prob[entries]
+        self.next = (self.next + len(rows)) % self.capacity
+        self.size = min(self.capacity, self.size + len(rows))
+
+    # ingest a .done file, or a .cols directory written by columnar.py
+    def ingest(self, filename):
+        if os.path.isdir(filename):
+            cols = columnar.read_columns(filename)
+        else:
+            cols = loader.to_columns(loader.load_data([filename]))
+        rows = loader.balance_sample(cols.player, cols.outcome, self.rng)
+        self.add(loader.take_columns(cols, rows))
+        self.seen.add(filename)
+
+    # ingest all files matching the pattern that have not been seen yet, oldest first. On
+    # the first call only the last from_last_n files are ingested and the rest are skipped.
+    def poll(self, pattern, from_last_n=0):
+        filenames = sorted(glob.glob(pattern))
+        if not self.seen:
+            self.seen.update(filenames[:-from_last_n] if from_last_n > 0 else [])
+        new_files = [f for f in filenames if f not in self.seen]
+        for filename in new_files:
+            self.ingest(filename)
+        return len(new_files)
+
+    # uniformly sample n positions (without replacement where possible) as a Columns
+    def sample(self, n):
+        if self.size == 0:
+            raise ValueError('cannot sample from an empty replay buffer')
+        if n < self.size:
+            rows = self.rng.choice(self.size, n, replace=False)
+        else:
+            rows = self.rng.integers(0, self.size, n)
+        counts = self.policy_count[rows].astype(np.int64)
+        offset = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offset[1:])
+        mask = np.arange(MAX_MOVES).reshape(1, MAX_MOVES) < counts.reshape(n, 1)
+        return loader.Columns(board=self.board[rows],
+                              player=self.player[rows],
+                              outcome=self.outcome[rows],
+                              game_length=self.game_length[rows],
+                              offset=offset,
+                              index=self.policy_index[rows][mask],
+                              prob=self.policy_prob[rows][mask])
@@ -0,0 +1,148 @@
+import getopt, os, socket, struct, sys, threading, time
+import numpy as np
+
+sys.path.append('.')
+sys.path.append('src/main/py')
+from maximum.industries.loader import NUM_INPUT_CHANNELS
+from maximum.industries.profiler import Profiler
+
+#
+# Local inference server shared by the engine processes of a node, so that the node holds
+# one copy of the model and positions from all of its engines are evaluated in shared
+# batches. Engines connect to a Unix socket with -a back=server (see play.load_model) and
+# send requests of
+#
+#   rows      uint32                    number of model input rows
+#   positions uint32                    number of positions, of one or four rows each
+#   inputs    rows * 17 * 8 * 8 int8    model inputs, which are all -1, 0 or 1
+#
+# and receive, for each request in turn,
+#
+#   value     rows float32
+#   policy    rows * 4096 float32
+#
+# Each connection is served by its own thread, and the requests of all connections go to a
+# play.Evaluator, which gathers them into batches of up to max_batch positions or
+# max_latency seconds and evaluates each batch in a single call of the model.
+#
+
+ROW_BYTES = NUM_INPUT_CHANNELS * 8 * 8
+POLICY_SIZE = 8 * 8 * 8 * 8
+REPORT_INTERVAL = 60.0
+
+
+# exactly n bytes from a socket, or None if it is closed before the first one
+def recv_exactly(conn, n):
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = conn.recv_into(view[received:])
+        if count == 0:
+            if received == 0:
+                return None
+            raise EOFError('connection closed mid-message')
+        received += count
+    return data
+
+
+def handle(conn, evaluator, profiler):
+    with conn:
+        while True:
+            header = recv_exactly(conn, 8)
+            if header is None:
+                return
+            rows, positions = struct.unpack('<II', header)
+            inputs = np.frombuffer(recv_exactly(conn, rows * ROW_BYTES), dtype=np.int8)
+            inputs = inputs.reshape(rows, NUM_INPUT_CHANNELS, 8, 8).astype(np.float32)
+            value, policy = evaluator.evaluate(inputs, positions)
+            conn.sendall(np.ascontiguousarray(value, dtype=np.float32).tobytes() +
+                         np.ascontiguousarray(policy, dtype=np.float32).tobytes())
+            profiler.count('requests')
+            profiler.count('positions', positions)
+            profiler.count('rows', rows)
+
+
+# print the evaluator's batch sizes and request counts every REPORT_INTERVAL seconds
+def report_loop(profiler):
+    while True:
+        time.sleep(REPORT_INTERVAL)
+        record = profiler.report(seconds=REPORT_INTERVAL)
+        counters = record['counters']
+        print('%s requests, %s positions, %s rows, batch sizes %s' %
+              (counters.get('requests', 0), counters.get('positions', 0),
+               counters.get('rows', 0), record['histograms'].get('evaluator_batch', {})))
+
+
+def serve(model, socket_path, max_batch, max_latency, log_path=None):
+    from maximum.industries.play import Evaluator
+    profiler = Profiler(log_path)
+    evaluator = Evaluator(model, max_batch, max_latency, profiler)
+    threading.Thread(target=report_loop, args=(profiler,), daemon=True).start()
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(128)
+    print('serving on %s' % socket_path)
+    try:
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=handle, args=(conn, evaluator, profiler), daemon=True).start()
+    finally:
+        listener.close()
+        os.remove(socket_path)
+
+
+# Client side of the server, used by engines as their model. Calls are serialized with a
+# lock, and a process forked after the model was created opens its own connection, so one
+# RemoteModel may be shared by threads and by self-play worker processes.
+class RemoteModel(object):
+    takes_positions = True
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+
+    # returns (value, policy) for a batch of model inputs, like play.Model, given the
+    # number of positions they are of (see play.evaluate_positions)
+    def evaluate(self, inputs, positions):
+        rows = len(inputs)
+        with self.lock:
+            if self.pid != os.getpid():
+                self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.conn.connect(self.socket_path)
+                self.pid = os.getpid()
+            self.conn.sendall(struct.pack('<II', rows, positions) +
+                              np.asarray(inputs).astype(np.int8).tobytes())
+            data = recv_exactly(self.conn, rows * 4 * (1 + POLICY_SIZE))
+        value = np.frombuffer(data, dtype=np.float32, count=rows).reshape(rows, 1)
+        policy = np.frombuffer(data, dtype=np.float32, offset=rows * 4).reshape(rows, POLICY_SIZE)
+        return value, policy
+
+
+def main(argv):
+    opts, _ = getopt.getopt(argv, 'hm:a:s:l:', [])
+    opts = dict(opts)
+    if '-h' in opts or '-m' not in opts:
+        print('server.py [-h] // help')
+        print('          -m <model> // e.g., tfmodels/r14/1549380964')
+        print('          [-a <args>] // back, ebat (positions per batch) and elat (milliseconds)')
+        print('          [-s <socket>] // Unix socket to listen on')
+        print('          [-l <log>] // append batch statistics to this file as JSON lines')
+        exit()
+
+    from maximum.industries.play import argdict, load_model
+    args = argdict(opts['-a']) if '-a' in opts else {}
+    socket_path = opts['-s'] if '-s' in opts else '/tmp/chessai.sock'
+    max_batch = int(args['ebat']) if 'ebat' in args else 64
+    max_latency = float(args['elat']) if 'elat' in args else 5
+
+    serve(load_model(opts['-m'], args), socket_path, max_batch, max_latency / 1000.0,
+          opts['-l'] if '-l' in opts else None)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,39 +1,135 @@
 import concurrent.futures
-import getopt, os, pickle, sys, time
+import getopt, glob, os, sys, time
 import numpy as np
+from multiprocessing import shared_memory
+from google.protobuf.internal.decoder import _DecodeVarint32
 
 sys.path.append('.')
 sys.path.append('src/main/py')
+import maximum.industries.columnar as columnar
 import maximum.industries.loader as loader
+import maximum.industries.replay as replay
 
 
 # We'll use a pool of worker processes to load and transform the input data in parallel.
 # This is time consuming and would otherwise stall training and cause low GPU utilization.
 #
-# The results from ProcessPoolExecutor work are passed between processes via pickle. If
-# we pass numpy arrays by pickling them directly then we wind up with large memory leaks.
-# Pickle does not seem to manage the reference counts correctly for numpy objects. We
-# work around this by using numpy's own method to serialize its arrays, and then picke
-# tuple containing the serialized bytes and shapes.
-def pack(data):
-    x, y, z = data
-    return pickle.dumps((x.tobytes(), x.shape, y.tobytes(), y.shape, z.tobytes(), z.shape))
+# Batches are handed back through a ring of shared memory slots rather than being pickled.
+# Each slot holds x_input, y_value and y_policy arrays for up to 'capacity' rows. A worker
+# is given the name of a free slot, transforms its data directly into it and returns only
+# the number of rows written. The trainer then uses views of the slot without copying.
+# There are twice as many slots as workers, so workers can fill the next round of slots
+# while the trainer is still using the previous round.
+#
+# Slots live in /dev/shm. At the dense policy width a row takes about 20KB (17x8x8 inputs,
+# a value and 4096 policy columns in float32), so e.g. a 20000 row slot takes about 415MB
+# and the 4 slots of two workers 1.7GB. By default slots are sized for the balanced load
+# the workers can be expected to draw (see slot_rows). A load that does not fit is
+# transformed into private arrays instead, which are pickled back to the trainer, so no
+# positions are dropped and training goes on, at the cost of a copy.
+def row_shapes(sparse_width):
+    return [(loader.NUM_INPUT_CHANNELS, 8, 8), (1,), (loader.policy_width(sparse_width),)]
+
+
+def slot_size(capacity, sparse_width):
+    return (capacity * sum(int(np.prod(shape)) for shape in row_shapes(sparse_width)) *
+            np.dtype(loader.DTYPE).itemsize)
+
+
+def slot_views(buf, capacity, rows, sparse_width):
+    views = []
+    offset = 0
+    for shape in row_shapes(sparse_width):
+        views.append(np.ndarray((rows,) + shape, dtype=loader.DTYPE, buffer=buf, offset=offset))
+        offset += capacity * int(np.prod(shape)) * np.dtype(loader.DTYPE).itemsize
+    return tuple(views)
 
 
-def unpack(data):
-    x, xs, y, ys, z, zs = pickle.loads(data)
-    return (np.frombuffer(x, dtype=loader.DTYPE).reshape(xs),
-            np.frombuffer(y, dtype=loader.DTYPE).reshape(ys),
-            np.frombuffer(z, dtype=loader.DTYPE).reshape(zs))
+# transform a Columns into a slot, returning the number of rows, or if they do not fit
+# into new arrays, returning those
+def fill_slot(cols, slot_name, capacity, sparse_width):
+    rows = len(cols.board) * 4
+    if rows > capacity:
+        print('%d rows do not fit a slot of %d rows, passing them by copy' % (rows, capacity))
+        return loader.transform_columns(cols, sparse_width=sparse_width)
+    slot = shared_memory.SharedMemory(name=slot_name)
+    views = slot_views(slot.buf, capacity, rows, sparse_width)
+    loader.transform_columns(cols, out=views, sparse_width=sparse_width)
+    # views must be released before the slot can be closed
+    del views
+    slot.close()
+    return rows
 
 
 # This function will be invoked in worker subprocesses to load data in the background
 # while training occurs in the main process. Each subprocess is forked and initially
-# shares memory including random number generator state. We first reinitialize RNG state
-# for each process (by default from /dev/urandom).
-def worker_load_data(data_pattern, choose_n, from_last_n):
-    np.random.set_state(np.random.RandomState().get_state())
-    return pack(loader.load_balance_transform('%s.*.done' % data_pattern, choose_n, from_last_n))
+# shares memory including random number generator state, so each task draws from its own
+# np.random.Generator. Without a --seed it is seeded from /dev/urandom, and with one the
+# task seeded with [seed, round, slot] always reproduces the same data. Columnar data (see
+# columnar.py) is sampled from memory-mapped .cols directories instead of parsing .done files.
+def worker_load_data(data_pattern, choose_n, from_last_n, use_columnar, slot_name, capacity,
+                     sparse_width, seed):
+    rng = np.random.default_rng(seed)
+    if use_columnar:
+        cols = columnar.load_balance('%s.*.cols' % data_pattern, choose_n, from_last_n, rng)
+    else:
+        cols = loader.load_balance('%s.*.done' % data_pattern, choose_n, from_last_n, rng)
+    return fill_slot(cols, slot_name, capacity, sparse_width)
+
+
+# With --replay a single long-lived worker process keeps a replay buffer of the most recent
+# positions. Each call ingests any data files that appeared since the last call, then
+# samples a full slot of balanced positions from the buffer. Until the buffer holds any
+# positions, e.g. before self-play has written its first file, it polls every
+# REPLAY_WAIT_SECONDS.
+replay_buffer = None
+REPLAY_WAIT_SECONDS = 10
+
+
+def worker_replay_data(data_pattern, from_last_n, use_columnar, replay_capacity, slot_name, capacity,
+                       sparse_width, seed):
+    global replay_buffer
+    if replay_buffer is None:
+        replay_buffer = replay.ReplayBuffer(replay_capacity, np.random.default_rng(seed))
+    suffix = 'cols' if use_columnar else 'done'
+    new_files = replay_buffer.poll('%s.*.%s' % (data_pattern, suffix), from_last_n)
+    while replay_buffer.size == 0:
+        print('replay buffer is empty, waiting for %s.*.%s' % (data_pattern, suffix))
+        time.sleep(REPLAY_WAIT_SECONDS)
+        new_files += replay_buffer.poll('%s.*.%s' % (data_pattern, suffix), from_last_n)
+    if new_files > 0:
+        print('replay buffer ingested %d files, holds %d positions' % (new_files, replay_buffer.size))
+    return fill_slot(replay_buffer.sample(capacity // 4), slot_name, capacity, sparse_width)
+
+
+# number of positions in a .done file, from the length prefixes of its messages alone, or
+# in a .cols directory
+def file_positions(filename):
+    if os.path.isdir(filename):
+        return len(np.load('%s/player.npy' % filename, mmap_mode='r'))
+    with open(filename, 'rb') as f:
+        buf = f.read()
+    count = 0
+    pos = 0
+    while pos < len(buf):
+        msg_len, pos = _DecodeVarint32(buf, pos)
+        pos += msg_len
+        count += 1
+    return count
+
+
+# Rows a slot needs for a balanced load of choose_n of the files matching pattern, estimated
+# from the size of the most recent SIZE_SAMPLE_FILES of them. loader.balance_sample keeps
+# at most BALANCED_SHARE of the positions of each decisive outcome and fewer draws, and a
+# load has 4 rows per position.
+SIZE_SAMPLE_FILES = 3
+BALANCED_SHARE = 0.4
+
+
+def slot_rows(pattern, choose_n):
+    filenames = sorted(glob.glob(pattern))[-SIZE_SAMPLE_FILES:]
+    largest = max([file_positions(f) for f in filenames], default=0)
+    return max(4, int(4 * choose_n * largest * BALANCED_SHARE))
 
 
 def get_opt(opts, opt, opttype, default):
@@ -47,7 +143,8 @@ def get_opt(opts, opt, opttype, default):
 
 
 def main(argv):
-    opts, args = getopt.getopt(argv, 'hb:c:d:f:l:o:r:s:tv:', ['ldecay=', 'rdecay=', 'data='])
+    opts, args = getopt.getopt(argv, 'hb:c:d:f:l:o:r:s:tv:', ['ldecay=', 'rdecay=', 'data=', 'columnar',
+                                                              'replay=', 'seed=', 'slot=', 'sparse='])
     opts = dict(opts)
     if '-h' in opts:
         print('train.py [-h] // help')
@@ -62,8 +159,16 @@ def main(argv):
         print('         [-t] // use tensorboard')
         print('         [-v <num_validation_files>]')
         print('         [--data <data>] // e.g., data/shuffled')
+        print('         [--columnar] // read .cols data written by columnar.py')
         print('         [--ldecay <lastn_decay>]')
         print('         [--rdecay <rate_decay>]')
+        print('         [--replay <positions>] // sample from a replay buffer of this size')
+        print('         [--seed <seed>] // make data loading reproducible')
+        print('         [--slot <rows>] // capacity of each shared memory slot in /dev/shm,')
+        print('                         // about 20KB per row at the dense policy width.')
+        print('                         // Defaults to the expected balanced load, or 20000')
+        print('                         // rows with --replay. Larger loads are copied.')
+        print('         [--sparse <moves>] // sparse policy targets of this many moves')
         exit()
         
     batch = get_opt(opts, '-b', int, 1000)
@@ -79,31 +184,60 @@ def main(argv):
     data_pattern = get_opt(opts, '--data', str, 'shuffled')
     rate_decay = get_opt(opts, '--rdecay', float, 1.0)
     last_decay = get_opt(opts, '--ldecay', float, 1.0)
+    use_columnar = get_opt(opts, '--columnar', bool, False)
+    capacity = get_opt(opts, '--slot', int, None)
+    replay_capacity = get_opt(opts, '--replay', int, 0)
+    seed = get_opt(opts, '--seed', int, None)
+    sparse_width = get_opt(opts, '--sparse', int, 0)
 
     # Set CUDA_DEVICE_ORDER so cuda libs number devices in the same way as nvidia-smi
     os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
     os.environ['CUDA_VISIBLE_DEVICES'] = device
 
-    num_workers = 2  # two seem to be enough
+    num_workers = 1 if replay_capacity > 0 else 2  # two seem to be enough
+    if capacity is None:
+        suffix = 'cols' if use_columnar else 'done'
+        capacity = (20000 if replay_capacity > 0 else
+                    slot_rows('%s.*.%s' % (data_pattern, suffix), 6))
+    print('%d shared memory slots of %d rows, %.0fMB each' %
+          (2 * num_workers, capacity, slot_size(capacity, sparse_width) / 1e6))
+    slots = [shared_memory.SharedMemory(create=True, size=slot_size(capacity, sparse_width))
+             for _ in range(2 * num_workers)]
+    slot_rounds = [slots[:num_workers], slots[num_workers:]]
     with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        def load_round(r):
+            seeds = [None if seed is None else [seed, r, i] for i in range(num_workers)]
+            if replay_capacity > 0:
+                return [(executor.submit(worker_replay_data, data_pattern, from_last_n, use_columnar,
+                                         replay_capacity, slot.name, capacity, sparse_width,
+                                         seeds[i]), slot)
+                        for i, slot in enumerate(slot_rounds[r % 2])]
+            return [(executor.submit(worker_load_data, data_pattern, 6, from_last_n, use_columnar,
+                                     slot.name, capacity, sparse_width, seeds[i]), slot)
+                    for i, slot in enumerate(slot_rounds[r % 2])]
+
         # pre-load the first batch of training data. 
-        nextdata = [executor.submit(worker_load_data, data_pattern, 6, from_last_n)
-                    for _ in range(num_workers)]
+        nextdata = load_round(0)
         
         # construct model after workers are forked to keep forked processes small
         import maximum.industries.modeldef as modeldef
         if from_model:
             from tensorflow.keras.models import load_model
             import tensorflow.keras.backend as K
-            model = load_model(from_model)
+            model = load_model(from_model,
+                               custom_objects={'sparse_policy_loss': modeldef.sparse_policy_loss})
+            # recompile in case the model was trained with the other kind of policy target
+            modeldef.compile_model(model, model.optimizer, sparse_policy=sparse_width > 0)
             K.set_value(model.optimizer.lr, rate)  # override previous learning rate
         else:
-            model = modeldef.make_model(filters=config[0], blocks=config[1], rate=rate)
+            model = modeldef.make_model(filters=config[0], blocks=config[1], rate=rate,
+                                        sparse_policy=sparse_width > 0)
 
         # load validation data if requested
         validation_data = None
         if num_validation > 0:
-            xt_input, yt_value, yt_policy = loader.load_balance_transform('%s.*.test' % data_pattern, num_validation)
+            xt_input, yt_value, yt_policy = loader.load_balance_transform('%s.*.test' % data_pattern, num_validation,
+                                                                          sparse_width=sparse_width)
             validation_data = (xt_input, {'value': yt_value, 'policy': yt_policy})
 
         # create tensorboard callback if requested
@@ -120,29 +254,36 @@ def main(argv):
             callbacks.append(LearningRateScheduler(lambda _: rate * rate_decay ** int(epoch/20)))
             
         # training loop
-        while True:
-            # let 'loaded' be a list of futures with pre-loaded data
-            loaded = nextdata
-            # submit another round of pre-load requests
-            nextdata = [executor.submit(worker_load_data, data_pattern, 6, from_last_n)
-                        for _ in range(num_workers)]
-            if epoch % 20 == 0:
-                from_last_n = int(from_last_n * last_decay)
-
-            for future in loaded:
-                # unpack loaded data. result() will block if the data is not ready yet.
-                x_input, y_value, y_policy = unpack(future.result())
-                model.fit(x_input, {'value': y_value, 'policy': y_policy},
-                          validation_data=validation_data,
-                          batch_size=batch,
-                          epochs=1,
-                          verbose=1,
-                          callbacks=callbacks)
-                if epoch % save_every == 0:
-                    print('saving model after %d epochs' % epoch)
-                    modeldef.save_model(model, outdir)
-                epoch += 1
+        try:
+            rounds = 0
+            while True:
+                # let 'loaded' be a list of futures with pre-loaded data
+                loaded = nextdata
+                # submit another round of pre-load requests into the other round of slots
+                rounds += 1
+                nextdata = load_round(rounds)
+                if epoch % 20 == 0:
+                    from_last_n = int(from_last_n * last_decay)
 
+                for future, slot in loaded:
+                    # view loaded data in place, unless it did not fit the slot (see
+                    # fill_slot). result() will block if the data is not ready yet.
+                    result = future.result()
+                    x_input, y_value, y_policy = (slot_views(slot.buf, capacity, result, sparse_width)
+                                                  if isinstance(result, int) else result)
+                    model.fit(x_input, {'value': y_value, 'policy': y_policy},
+                              validation_data=validation_data,
+                              batch_size=batch,
+                              epochs=1,
+                              verbose=1,
+                              callbacks=callbacks)
+                    if epoch % save_every == 0:
+                        print('saving model after %d epochs' % epoch)
+                        modeldef.save_model(model, outdir, parity_inputs=x_input[:256])
+                    epoch += 1
+        finally:
+            for slot in slots:
+                slot.unlink()
 
 if __name__ == '__main__':
     main(sys.argv[1:])
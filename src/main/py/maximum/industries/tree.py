@@ -0,0 +1,123 @@
+import chess
+import numpy as np
+
+#
+# Array-backed MCTS tree. Nodes are indices into preallocated numpy arrays rather than
+# Python objects, and the children of a node are stored contiguously, so that all of them
+# can be read as slices:
+#
+#   visits        number of visits (or virtual visits) to the node
+#   value_sum     sum of values, from the perspective of the player to move at the node
+#   prior         prior probability of the move leading to the node
+#   first_child   index of the first child, or -1 if the node has not been expanded
+#   num_children  number of children
+#   move          move_code of the move leading to the node
+#   terminal      0 if not yet known, 1 if the game is over at the node, -1 if not
+#   result        if terminal, the value of the final position for the player to move
+#   virtual_loss  virtual loss on the node from playouts still waiting for the model, which
+#                 is included in its visits and value_sum
+#
+# Node 0 is always the root. Moving the root to one of its children compacts the subtree
+# below that child into a fresh set of arrays, so memory stays bounded over a game.
+#
+
+FIELDS = [('visits', np.float64),
+          ('value_sum', np.float64),
+          ('prior', np.float32),
+          ('first_child', np.int32),
+          ('num_children', np.int32),
+          ('move', np.int32),
+          ('terminal', np.int8),
+          ('result', np.float32),
+          ('virtual_loss', np.float64)]
+
+
+# Moves are stored as from_square | to_square << 6 | promotion << 12. The null move (used
+# to claim a draw) has code 0.
+def move_code(move):
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def code_move(code):
+    code = int(code)
+    return chess.Move(code & 63, (code >> 6) & 63, (code >> 12) or None)
+
+
+class Tree(object):
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        for name, dtype in FIELDS:
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.reset()
+
+    # discard all nodes but a fresh, unexpanded root
+    def reset(self):
+        self.size = 1
+        for name, _ in FIELDS:
+            getattr(self, name)[0] = 0
+        self.first_child[0] = -1
+
+    def expanded(self, node):
+        return self.first_child[node] >= 0
+
+    def children(self, node):
+        start = self.first_child[node]
+        return np.arange(start, start + self.num_children[node])
+
+    # add children with the given move codes and priors to an unexpanded node
+    def expand(self, node, moves, priors):
+        n = len(moves)
+        if self.size + n > self.capacity:
+            self.grow(self.size + n)
+        start = self.size
+        end = start + n
+        for name, _ in FIELDS:
+            getattr(self, name)[start:end] = 0
+        self.first_child[start:end] = -1
+        self.move[start:end] = moves
+        self.prior[start:end] = priors
+        self.first_child[node] = start
+        self.num_children[node] = n
+        self.size = end
+        return start
+
+    def grow(self, size):
+        capacity = max(size, 2 * self.capacity)
+        for name, dtype in FIELDS:
+            array = np.zeros(capacity, dtype=dtype)
+            array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    # return the child of node reached by the given move, or -1
+    def find_child(self, node, move):
+        if not self.expanded(node):
+            return -1
+        children = self.children(node)
+        found = np.flatnonzero(self.move[children] == move_code(move))
+        return children[found[0]] if len(found) > 0 else -1
+
+    # Make 'node' the new root, keeping only its subtree. The subtree is copied one level
+    # at a time, so each level (and the children of each node) stays contiguous.
+    def reroot(self, node):
+        old = {name: getattr(self, name) for name, _ in FIELDS}
+        new = {name: np.zeros(self.capacity, dtype=dtype) for name, dtype in FIELDS}
+        frontier = np.array([node])
+        start = 0
+        size = 1
+        while len(frontier) > 0:
+            ids = np.arange(start, start + len(frontier))
+            for name, _ in FIELDS:
+                new[name][ids] = old[name][frontier]
+            counts = old['num_children'][frontier]
+            offsets = np.cumsum(counts) - counts
+            new['first_child'][ids] = np.where(old['first_child'][frontier] >= 0, size + offsets, -1)
+            total = counts.sum()
+            frontier = (np.repeat(old['first_child'][frontier] - offsets, counts) +
+                        np.arange(total))
+            start = size
+            size += total
+        for name, _ in FIELDS:
+            setattr(self, name, new[name])
+        self.size = size
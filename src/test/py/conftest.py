@@ -0,0 +1,90 @@
+import os, sys
+import chess
+import numpy as np
+import pytest
+from google.protobuf.internal import encoder
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'main', 'py')))
+import maximum.industries.instance_pb2 as instance_pb2
+from maximum.industries.play import to_board_state
+
+
+# a TrainingInstance of a position with random tree search results over its legal moves,
+# one per move as Engine.get_training_instance writes them, so all four promotions of a
+# pawn share a policy index
+def searched_instance(board, rng):
+    inst = instance_pb2.TrainingInstance()
+    inst.player = instance_pb2.WHITE if board.turn else instance_pb2.BLACK
+    inst.board_state = to_board_state(board)
+    moves = list(board.legal_moves)
+    for move, prob in zip(moves, rng.dirichlet(np.full(len(moves), 0.3))):
+        tsr = inst.tree_search_result.add()
+        tsr.index = move.from_square * 64 + move.to_square
+        tsr.prob = prob
+    return inst
+
+
+# TrainingInstances from random games, with random tree search results over the legal
+# moves of each position and the game's result as outcome
+def random_instances(num_games, seed, max_moves=80):
+    rng = np.random.default_rng(seed)
+    insts = []
+    for _ in range(num_games):
+        board = chess.Board()
+        game = []
+        while not board.is_game_over() and len(board.move_stack) < max_moves:
+            game.append(searched_instance(board, rng))
+            moves = list(board.legal_moves)
+            board.push(moves[rng.integers(len(moves))])
+        white_score = {'1-0': 1, '0-1': -1}.get(board.result(), int(rng.integers(-1, 2)))
+        for inst in game:
+            inst.outcome = white_score if inst.player == instance_pb2.WHITE else -white_score
+            inst.game_length = len(board.move_stack)
+        insts += game
+    return insts
+
+
+def write_instances(filename, insts):
+    with open(filename, 'wb') as f:
+        for inst in insts:
+            f.write(encoder._VarintBytes(inst.ByteSize()))
+            f.write(inst.SerializeToString())
+
+
+# instances of positions where either side can promote, with and without capturing
+PROMOTION_FENS = ['1r2k3/2P5/8/8/8/8/8/4K3 w - - 0 1',
+                  '4k3/8/8/8/8/8/1p4p1/R3K2N b - - 0 1']
+
+
+def promotion_instances(seed):
+    rng = np.random.default_rng(seed)
+    insts = [searched_instance(chess.Board(fen), rng) for fen in PROMOTION_FENS]
+    for inst in insts:
+        inst.outcome = 1
+        inst.game_length = 100
+    return insts
+
+
+@pytest.fixture
+def instances():
+    return random_instances(4, seed=0) + promotion_instances(seed=0)
+
+
+# A deterministic stand-in for play.Model: the value and policy logits are fixed random
+# linear functions of the model inputs, so each reflection of a position gets different
+# outputs
+class FakeModel(object):
+
+    def __init__(self, seed=0):
+        rng = np.random.default_rng(seed)
+        size = 17 * 8 * 8
+        self.value_weights = rng.normal(scale=0.1, size=(size, 1)).astype(np.float32)
+        self.policy_weights = rng.normal(scale=0.1, size=(size, 4096)).astype(np.float32)
+        self.rows = 0
+
+    def evaluate(self, inputs):
+        x = np.asarray(inputs, dtype=np.float32).reshape(len(inputs), -1)
+        self.rows += len(x)
+        logits = x @ self.policy_weights
+        policy = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return np.tanh(x @ self.value_weights), policy / policy.sum(axis=1, keepdims=True)
@@ -0,0 +1,53 @@
+import chess
+import numpy as np
+import maximum.industries.loader as loader
+from maximum.industries.book import Book, aggregate, search_visits, write_book
+from maximum.industries.play import Engine, to_board_state
+from conftest import FakeModel, random_instances
+
+
+# instances of the starting position from searches with the given visits of e2e4 and d2d4
+def searched_instances(visits):
+    insts = random_instances(1, seed=0, max_moves=1)
+    inst = insts[0]
+    del inst.tree_search_result[:]
+    total = sum(visits)
+    for move, v in zip(['e2e4', 'd2d4'], visits):
+        move = chess.Move.from_uci(move)
+        tsr = inst.tree_search_result.add()
+        tsr.index = move.from_square * 64 + move.to_square
+        tsr.prob = v / total
+    return inst
+
+
+def test_search_visits_recovers_visit_totals():
+    insts = [searched_instances([1, 3]), searched_instances([7, 1]), searched_instances([1, 99])]
+    assert list(search_visits(loader.to_columns(insts))) == [4, 8, 100]
+
+
+def test_book_policy_is_weighted_by_visits():
+    # a small search prefers d2d4, a search ten times the size e2e4
+    insts = [searched_instances([1, 9]), searched_instances([99, 1])]
+    book = aggregate(loader.to_columns(insts), 1)
+    e2e4, d2d4 = 12 * 64 + 28, 11 * 64 + 27
+    prob = dict(zip(book['index'], book['prob']))
+    assert np.isclose(prob[e2e4], 100 / 110)
+    assert np.isclose(prob[d2d4], 10 / 110)
+    assert list(book['count']) == [2]
+
+
+def test_book_priors_are_mixed_into_the_root_once(tmp_path):
+    insts = [searched_instances([1, 3]) for _ in range(4)]
+    write_book(str(tmp_path / 'book'), aggregate(loader.to_columns(insts), 1))
+    board_state = to_board_state(chess.Board())
+    assert Book(str(tmp_path / 'book')).lookup(board_state, 0)[0] == 4
+
+    engine = Engine(FakeModel(), {'book': str(tmp_path / 'book'), 'bkmn': '100', 'iter': '20'},
+                    quiet=True)
+    priors = []
+    for _ in range(3):
+        assert engine.book_move() is None
+        engine.run(engine.playouts())
+        priors.append(engine.tree.prior[engine.tree.children(0)].copy())
+    assert np.array_equal(priors[0], priors[1])
+    assert np.array_equal(priors[0], priors[2])
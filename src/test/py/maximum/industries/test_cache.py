@@ -0,0 +1,19 @@
+from maximum.industries.cache import EvalCache
+
+
+def test_evicts_least_recently_used():
+    cache = EvalCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert (cache.hits, cache.misses, len(cache)) == (3, 1, 2)
+
+
+def test_zero_capacity_caches_nothing():
+    cache = EvalCache(0)
+    cache.put('a', 1)
+    assert cache.get('a') is None
+    assert len(cache) == 0
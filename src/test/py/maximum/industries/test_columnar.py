@@ -0,0 +1,41 @@
+import os
+import numpy as np
+import maximum.industries.columnar as columnar
+import maximum.industries.loader as loader
+from conftest import random_instances, write_instances
+
+
+def assert_same_columns(a, b):
+    for field in loader.Columns._fields:
+        assert np.array_equal(getattr(a, field), getattr(b, field)), field
+
+
+def test_read_columns_matches_to_columns(instances, tmp_path):
+    filename = str(tmp_path / 'data.1.done')
+    write_instances(filename, instances)
+    path = columnar.convert(filename)
+    assert path == str(tmp_path / 'data.1.cols')
+    assert not os.path.exists('%s.work' % path)
+    assert_same_columns(columnar.read_columns(path), loader.to_columns(instances))
+
+
+def test_load_balance_matches_loader(instances, tmp_path):
+    filename = str(tmp_path / 'data.1.done')
+    write_instances(filename, instances)
+    columnar.convert(filename)
+    # with a single file both balance the same rows with the same generator
+    expected = loader.load_balance(str(tmp_path / 'data.*.done'), 1, rng=np.random.default_rng(3))
+    actual = columnar.load_balance(str(tmp_path / 'data.*.cols'), 1, rng=np.random.default_rng(3))
+    assert_same_columns(actual, expected)
+
+
+def test_load_balance_is_reproducible(tmp_path):
+    for i in range(3):
+        filename = str(tmp_path / ('data.%d.done' % i))
+        write_instances(filename, random_instances(2, seed=i))
+        columnar.convert(filename)
+    pattern = str(tmp_path / 'data.*.cols')
+    first = columnar.load_balance(pattern, 4, rng=np.random.default_rng(5))
+    second = columnar.load_balance(pattern, 4, rng=np.random.default_rng(5))
+    assert len(first.board) > 0
+    assert_same_columns(first, second)
@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+import maximum.industries.loader as loader
+
+
+def test_transform_matches_transform_loop(instances):
+    expected = loader.transform_loop(instances)
+    actual = loader.transform(instances)
+    for a, b in zip(expected, actual):
+        assert a.dtype == b.dtype
+        assert np.array_equal(a, b)
+
+
+def test_transform_columns_fills_out_in_place(instances):
+    cols = loader.to_columns(instances)
+    n = 4 * len(instances)
+    out = (np.ones((n, loader.NUM_INPUT_CHANNELS, 8, 8), dtype=loader.DTYPE),
+           np.ones((n, 1), dtype=loader.DTYPE),
+           np.ones((n, loader.policy_width()), dtype=loader.DTYPE))
+    loader.transform_columns(cols, out=out)
+    for a, b in zip(loader.transform_loop(instances), out):
+        assert np.array_equal(a, b)
+
+
+def test_take_and_concat_columns_round_trip(instances):
+    cols = loader.to_columns(instances)
+    half = len(instances) // 2
+    parts = [loader.take_columns(cols, np.arange(half)),
+             loader.take_columns(cols, np.arange(half, len(instances)))]
+    joined = loader.concat_columns(parts)
+    for field in loader.Columns._fields:
+        assert np.array_equal(getattr(joined, field), getattr(cols, field))
+
+
+# modeldef's policy losses, in NumPy: Keras' categorical_crossentropy on dense targets and
+# sparse_policy_loss on sparse ones
+def dense_loss(y_true, y_pred, epsilon=1e-7):
+    y_pred = np.clip(y_pred / y_pred.sum(axis=1, keepdims=True), epsilon, 1 - epsilon)
+    return -(y_true * np.log(y_pred)).sum(axis=1)
+
+
+def sparse_loss(y_true, y_pred, epsilon=1e-7):
+    width = y_true.shape[1] // 2
+    index = y_true[:, :width].astype(np.int64)
+    picked = np.clip(np.take_along_axis(y_pred, index, axis=1), epsilon, 1 - epsilon)
+    return -(y_true[:, width:] * np.log(picked)).sum(axis=1)
+
+
+def softmax_predictions(n, seed):
+    logits = np.random.default_rng(seed).normal(size=(n, loader.policy_width()))
+    e = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def densify(y_sparse):
+    width = y_sparse.shape[1] // 2
+    y_dense = np.zeros((len(y_sparse), loader.policy_width()))
+    rows = np.repeat(np.arange(len(y_sparse)), width)
+    np.add.at(y_dense, (rows, y_sparse[:, :width].astype(np.int64).ravel()),
+              y_sparse[:, width:].ravel())
+    return y_dense
+
+
+def test_untruncated_sparse_loss_matches_dense_loss(instances):
+    cols = loader.to_columns(instances)
+    _, _, y_dense = loader.transform_columns(cols)
+    _, _, y_sparse = loader.transform_columns(cols, sparse_width=256)
+    y_pred = softmax_predictions(len(y_dense), seed=0)
+    assert np.allclose(sparse_loss(y_sparse, y_pred), dense_loss(y_dense, y_pred), rtol=1e-5)
+
+
+def test_truncated_sparse_targets_are_renormalized(instances):
+    cols = loader.to_columns(instances)
+    _, _, y_dense = loader.transform_columns(cols)
+    _, _, y_sparse = loader.transform_columns(cols, sparse_width=8)
+    assert np.allclose(y_sparse[:, 8:].sum(axis=1), 1, atol=1e-5)
+    # the kept moves are the most probable ones of the dense target, in the same proportions
+    y_truncated = densify(y_sparse)
+    kept = y_truncated > 0
+    assert np.all(y_dense[kept] > 0)
+    scale = y_truncated.sum(axis=1) / np.where(kept, y_dense, 0).sum(axis=1)
+    assert np.allclose(y_truncated[kept], (y_dense * scale.reshape(-1, 1))[kept], rtol=1e-4)
+    y_pred = softmax_predictions(len(y_dense), seed=1)
+    assert np.allclose(sparse_loss(y_sparse, y_pred), dense_loss(y_truncated, y_pred), rtol=1e-5)
+
+
+def test_adjust_entropy_segments_matches_adjust_entropy():
+    rng = np.random.default_rng(0)
+    # uniform to very peaked rows, which take from none to all 15 rounds of sharpening,
+    # and empty rows
+    counts = np.array([0, 1, 2, 5, 20, 40, 0, 218, 33] * 20)
+    offset = np.concatenate([[0], np.cumsum(counts)])
+    prob = np.concatenate([rng.dirichlet(np.full(c, alpha)) if c > 0 else []
+                           for c, alpha in zip(counts, rng.choice([0.01, 0.3, 100], len(counts)))])
+    prob = prob.astype(np.float32)
+    actual = loader.adjust_entropy_segments(prob, offset)
+    for i in range(len(counts)):
+        start, end = offset[i], offset[i + 1]
+        if end > start:
+            expected = loader.adjust_entropy(prob[start:end].astype(np.float64))
+            assert np.array_equal(actual[start:end], expected)
+
+
+def balance_classes(n, seed):
+    rng = np.random.default_rng(seed)
+    player = rng.integers(0, 2, n)
+    # more wins for white than for black, and many draws
+    outcome = rng.choice([-1, 0, 1], n, p=[0.3, 0.3, 0.4]) * np.where(player == 0, 1, -1)
+    return player, outcome
+
+
+def test_balance_sample_is_reproducible():
+    player, outcome = balance_classes(10000, seed=0)
+    first = loader.balance_sample(player, outcome, np.random.default_rng(7))
+    second = loader.balance_sample(player, outcome, np.random.default_rng(7))
+    other = loader.balance_sample(player, outcome, np.random.default_rng(8))
+    assert np.array_equal(first, second)
+    assert not np.array_equal(first, other)
+    assert np.all(np.diff(first) > 0)
+
+
+def test_balance_sample_shares():
+    player, outcome = balance_classes(200000, seed=1)
+    rows = loader.balance_sample(player, outcome, np.random.default_rng(0))
+    draws = outcome == 0
+    assert abs(draws[rows].sum() / draws.sum() - 0.1) < 0.01
+    decisive = rows[outcome[rows] != 0]
+    classes = 2 * player[decisive] + (outcome[decisive] + 1) // 2
+    shares = np.bincount(classes, minlength=4) / len(decisive)
+    assert np.all(np.abs(shares - 0.25) < 0.03)
+
+
+def test_promotions_sharing_a_policy_index_are_merged():
+    from conftest import promotion_instances
+    insts = promotion_instances(seed=1)
+    assert all(len({tsr.index for tsr in inst.tree_search_result}) < len(inst.tree_search_result)
+               for inst in insts)
+    _, _, y_dense = loader.transform(insts)
+    _, _, y_sparse = loader.transform_columns(loader.to_columns(insts), sparse_width=256)
+    assert np.allclose(y_dense.sum(axis=1), 1, atol=1e-5)
+    assert np.allclose(densify(y_sparse), y_dense, atol=1e-7)
+    # each index appears once in the sparse target
+    for row in y_sparse:
+        indices = row[:256][row[256:] > 0]
+        assert len(np.unique(indices)) == len(indices)
+
+
+def test_sparse_targets_need_float32(instances, monkeypatch):
+    monkeypatch.setattr(loader, 'DTYPE', 'float16')
+    with pytest.raises(Exception, match='float32'):
+        loader.transform_columns(loader.to_columns(instances), sparse_width=8)
@@ -0,0 +1,38 @@
+import glob
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+import maximum.industries.loader as loader
+import maximum.industries.modeldef as modeldef
+
+
+# A small model whose normalizations have non-trivial statistics, so that folding them
+# changes every weighted layer they touch
+@pytest.fixture
+def model():
+    model = modeldef.make_model(filters=8, blocks=2, kernels=(3, 1))
+    rng = np.random.default_rng(0)
+    for layer in filter(modeldef.is_normalization, model.layers):
+        positive = ['gamma' in v.name or 'variance' in v.name for v in layer.weights]
+        layer.set_weights([rng.uniform(0.5, 1.5, w.shape) if p else rng.normal(0, 0.5, w.shape)
+                           for p, w in zip(positive, layer.get_weights())])
+    return model
+
+
+def test_layer_roles_match_between_training_and_inference_models(model):
+    inference = modeldef.make_model(filters=8, blocks=2, kernels=(3, 1), inference=True)
+    roles = modeldef.layer_roles(model)
+    inference_roles = modeldef.layer_roles(inference)
+    assert roles.keys() == inference_roles.keys()
+    for role, layer in roles.items():
+        assert [w.shape for w in layer.get_weights()] == \
+            [w.shape for w in inference_roles[role].get_weights()]
+
+
+def test_saved_model_matches_model(model, instances, tmp_path):
+    inputs, _, _ = loader.transform(instances[:64])
+    modeldef.save_model(model, str(tmp_path), parity_inputs=inputs)
+    export_dir = [d for d in glob.glob('%s/*' % tmp_path) if not d.endswith(('.h5', '.npz'))][0]
+    value, policy = modeldef.check_parity(model, export_dir, inputs)
+    assert value <= modeldef.PARITY_TOLERANCE and policy <= modeldef.PARITY_TOLERANCE
@@ -0,0 +1,63 @@
+import chess
+import numpy as np
+from maximum.industries.npmodel import NumpyModel
+from maximum.industries.play import to_model_input
+
+
+# random weights of a small network with the layout modeldef.export_numpy writes
+def random_arrays(rng, filters=8, blocks=2, kernels=(5, 3)):
+    def normal(*shape):
+        return rng.normal(scale=0.2, size=shape).astype(np.float32)
+
+    return {'input_kernel': normal(kernels[0], kernels[0], 17, filters),
+            'input_bias': normal(filters),
+            'block_a_kernel': normal(blocks, 3, 3, filters, filters),
+            'block_a_bias': normal(blocks, filters),
+            'block_b_kernel': normal(blocks, 3, 3, filters, filters),
+            'block_b_bias': normal(blocks, filters),
+            'policy_kernel': normal(kernels[1], kernels[1], filters, 64),
+            'policy_bias': normal(64),
+            'value_1_kernel': normal(filters * 64, 40), 'value_1_bias': normal(40),
+            'value_2_kernel': normal(40, 20), 'value_2_bias': normal(20),
+            'value_3_kernel': normal(20, 1), 'value_3_bias': normal(1)}
+
+
+# a 'same' convolution of channels-first x, one kernel offset at a time
+def naive_conv(x, kernel, bias):
+    k = kernel.shape[0]
+    p = k // 2
+    padded = np.pad(x, ((0, 0), (0, 0), (p, p), (p, p)))
+    out = np.zeros((len(x), kernel.shape[3], 8, 8))
+    for i in range(k):
+        for j in range(k):
+            out += np.einsum('nchw,co->nohw', padded[:, :, i:i + 8, j:j + 8], kernel[i, j])
+    return out + bias.reshape(1, -1, 1, 1)
+
+
+def naive_evaluate(arrays, inputs):
+    relu = lambda x: np.maximum(x, 0)
+    x = relu(naive_conv(inputs.astype(np.float64), arrays['input_kernel'], arrays['input_bias']))
+    for i in range(len(arrays['block_a_kernel'])):
+        y = relu(naive_conv(x, arrays['block_a_kernel'][i], arrays['block_a_bias'][i]))
+        x = relu(x + naive_conv(y, arrays['block_b_kernel'][i], arrays['block_b_bias'][i]))
+    v = x.reshape(len(x), -1)
+    for i in [1, 2]:
+        v = relu(v @ arrays['value_%d_kernel' % i] + arrays['value_%d_bias' % i])
+    value = np.tanh(v @ arrays['value_3_kernel'] + arrays['value_3_bias'])
+    logits = naive_conv(x, arrays['policy_kernel'], arrays['policy_bias']).reshape(len(x), -1)
+    policy = np.exp(logits - logits.max(axis=1, keepdims=True))
+    return value, policy / policy.sum(axis=1, keepdims=True)
+
+
+def test_numpy_model_matches_naive_convolutions(tmp_path):
+    rng = np.random.default_rng(0)
+    arrays = random_arrays(rng)
+    np.savez(str(tmp_path / 'model.npz'), **arrays)
+    boards = [chess.Board(),
+              chess.Board('r3k2r/pppq1ppp/2n2n2/3pp3/3PP3/2N2N2/PPPQ1PPP/R3K2R b Kq - 4 8')]
+    inputs = np.concatenate([to_model_input(board) for board in boards])
+    value, policy = NumpyModel(str(tmp_path / 'model.npz')).evaluate(inputs)
+    expected_value, expected_policy = naive_evaluate(arrays, inputs)
+    assert value.shape == (8, 1) and policy.shape == (8, 4096)
+    assert np.allclose(value, expected_value, atol=1e-5)
+    assert np.allclose(policy, expected_policy, rtol=1e-4, atol=1e-7)
@@ -0,0 +1,349 @@
+import sys
+import threading
+import time
+import chess
+import numpy as np
+import pytest
+from maximum.industries.cache import EvalCache
+import maximum.industries.play as play
+from maximum.industries.play import (Engine, Evaluator, SearchControl, parse_go, to_model_input,
+                                     to_model_input_reference)
+from maximum.industries.profiler import Profiler
+from maximum.industries.tree import move_code
+from conftest import FakeModel
+
+
+def make_engine(model, cache=None, **args):
+    args = {key: str(value) for key, value in args.items()}
+    return Engine(model, args, quiet=True, cache=cache)
+
+
+def root_priors(engine):
+    return engine.tree.prior[engine.tree.children(0)]
+
+
+def test_single_reflection_evaluations_are_not_reused_for_all_reflections():
+    model = FakeModel()
+    cache = EvalCache(1000)
+    one = make_engine(model, cache, symm='one', iter=20)
+    one.run(one.playouts())
+    assert len(cache) > 0
+
+    shared = make_engine(model, cache, symm='all', iter=1)
+    shared.run(shared.playouts())
+    fresh = make_engine(model, symm='all', iter=1)
+    fresh.run(fresh.playouts())
+    assert np.array_equal(root_priors(shared), root_priors(fresh))
+    assert shared.tree.value_sum[0] == fresh.tree.value_sum[0]
+
+
+# positions with some castling rights lost, an en passant square for either side (which the
+# encoding leaves out), black to move and promotions, and then the positions of random games
+ENCODING_FENS = ['r3k2r/pppq1ppp/2n2n2/3pp3/3PP3/2N2N2/PPPQ1PPP/R3K2R w Kq - 4 8',
+                 'rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3',
+                 'rnbqkbnr/pppp1ppp/8/8/3Pp3/4P3/PPP2PPP/RNBQKBNR b Qk d3 0 3',
+                 'r3k3/1P6/8/8/8/8/6p1/4K2R b Kq - 0 1']
+
+
+def test_to_model_input_matches_reference():
+    boards = [chess.Board(fen) for fen in ENCODING_FENS]
+    rng = np.random.default_rng(0)
+    for _ in range(4):
+        board = chess.Board()
+        while not board.is_game_over() and len(board.move_stack) < 80:
+            boards.append(board.copy())
+            moves = list(board.legal_moves)
+            board.push(moves[rng.integers(len(moves))])
+    assert any(not board.turn for board in boards)
+    for board in boards:
+        assert np.array_equal(to_model_input(board), to_model_input_reference(board))
+
+
+
+# Batch sizes are counted in positions, which with symm=one are a single row each
+def test_batch_sizes_count_positions():
+    engine = make_engine(FakeModel(), symm='one', leaf=8, iter=200, cach=0, prof=1)
+    engine.search()
+    profile = engine.last_profile
+    assert profile['counters']['rows'] == profile['counters']['evaluated']
+    batches = profile['histograms']['batch']
+    evaluated = profile['counters']['evaluated']
+    assert sum(int(size) * count for size, count in batches.items()) >= evaluated
+    assert max(batches, key=int) == '8'
+
+    # an Evaluator's batch is complete once it has max_batch positions
+    profiler = Profiler()
+    evaluator = Evaluator(FakeModel(), 8, 10.0, profiler)
+    inputs = to_model_input(chess.Board())
+    threads = [threading.Thread(target=evaluator.evaluate, args=(inputs[:1], 1))
+               for _ in range(8)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.time() - start < 5.0
+    assert profiler.report()['histograms']['evaluator_batch'] == {'8': 1}
+
+# A FakeModel that takes a while, so that the playouts of search threads overlap
+class SlowModel(FakeModel):
+
+    def evaluate(self, inputs):
+        time.sleep(0.002)
+        return super().evaluate(inputs)
+
+
+# the value each node was expanded with, and the number of expansions, i.e. backprops
+def record_leaf_values(engine):
+    values = {}
+    expansions = []
+    expand, expand_terminal = engine.expand, engine.expand_terminal
+
+    def record_expand(node, moves, claim_draw, value, priors):
+        values[node] = value
+        expansions.append(node)
+        expand(node, moves, claim_draw, value, priors)
+
+    def record_expand_terminal(node):
+        values[node] = engine.tree.result[node]
+        expansions.append(node)
+        expand_terminal(node)
+
+    engine.expand, engine.expand_terminal = record_expand, record_expand_terminal
+    return values, expansions
+
+
+# Every visit of a node either expanded it or passed through it to one of its children, so
+# its visits and value sum are its own plus those of its children, negated for the value.
+def check_totals(tree, values, node=0):
+    children = [c for c in tree.children(node) if tree.visits[c] > 0] if tree.expanded(node) else []
+    for child in children:
+        check_totals(tree, values, child)
+    assert tree.visits[node] == 1 + sum(tree.visits[c] for c in children)
+    assert np.isclose(tree.value_sum[node],
+                      values[node] - sum(tree.value_sum[c] for c in children), atol=1e-6)
+
+
+@pytest.mark.parametrize('threads', [1, 8])
+def test_threaded_search_totals(threads):
+    engine = make_engine(SlowModel(), thrd=threads, leaf=4, iter=400, cach=0, elat=1)
+    values, expansions = record_leaf_values(engine)
+    engine.threaded_playouts() if threads > 1 else engine.run(engine.playouts())
+    tree = engine.tree
+    assert np.all(tree.virtual_loss[:tree.size] == 0)
+    assert tree.visits[0] == len(expansions)
+    check_totals(tree, values)
+
+
+class FailingModel(FakeModel):
+
+    def evaluate(self, inputs):
+        if self.rows > 100:
+            raise RuntimeError('model failed')
+        return super().evaluate(inputs)
+
+
+def test_threaded_search_raises_model_errors():
+    engine = make_engine(FailingModel(), thrd=4, leaf=2, iter=1000, cach=0)
+    with pytest.raises(RuntimeError, match='model failed'):
+        engine.threaded_playouts()
+
+
+def test_threaded_search_raises_search_errors_and_releases_lock():
+    engine = make_engine(FakeModel(), thrd=4, leaf=2, iter=1000, cach=0)
+    expand = engine.expand
+    calls = []
+
+    def failing_expand(*args):
+        calls.append(args)
+        if len(calls) > 20:
+            raise RuntimeError('expand failed')
+        expand(*args)
+
+    engine.expand = failing_expand
+    with pytest.raises(RuntimeError, match='expand failed'):
+        engine.threaded_playouts()
+    # the next search of the engine still runs
+    engine.expand = expand
+    engine.tree.reset()
+    engine.iterations = 50
+    engine.threaded_playouts()
+    assert engine.search_nodes == 50
+    assert np.all(engine.tree.virtual_loss[:engine.tree.size] == 0)
+
+
+def test_parse_go():
+    toks = 'wtime 60000 btime 50000 winc 1000 binc 500 movestogo 20 ponder nodes'.split()
+    assert parse_go(toks) == {'wtime': 60000, 'btime': 50000, 'winc': 1000, 'binc': 500,
+                              'movestogo': 20, 'ponder': True}
+    assert parse_go(['infinite']) == {'infinite': True}
+    assert parse_go(['movetime', '100', 'nodes', '400']) == {'movetime': 100, 'nodes': 400}
+
+
+def test_budget():
+    engine = make_engine(FakeModel(), iter=800, ovhd=50, mtgo=30)
+    assert engine.budget(None, 100.0) == (800, None)
+    assert engine.budget({'infinite': True}, 100.0) == (sys.maxsize, None)
+    assert engine.budget({'ponder': True, 'movetime': 1000}, 100.0) == (sys.maxsize, None)
+    assert engine.budget({'nodes': 300}, 100.0) == (300, None)
+    assert engine.budget({'movetime': 1050}, 100.0) == (sys.maxsize, 101.0)
+    assert engine.budget({'movetime': 1050, 'nodes': 300}, 100.0) == (300, 101.0)
+    # the overhead never leaves less than a millisecond
+    assert engine.budget({'movetime': 40}, 100.0) == (sys.maxsize, 100.001)
+    # a share of the side to move's clock, plus most of its increment
+    limits = {'wtime': 60000, 'btime': 30000, 'winc': 1000, 'binc': 2000, 'movestogo': 20}
+    assert engine.budget(limits, 100.0) == (sys.maxsize, 100.0 + (3000 + 750 - 50) / 1000)
+    engine.board.push_uci('e2e4')
+    assert engine.budget(limits, 100.0) == (sys.maxsize, 100.0 + (1500 + 1500 - 50) / 1000)
+    # but never more than half of it
+    assert engine.budget({'btime': 1000, 'binc': 5000}, 100.0)[1] == 100.0 + 0.45
+
+
+def expand_root(engine, visits):
+    moves = list(engine.board.legal_moves)[:len(visits)]
+    engine.tree.expand(0, [move_code(m) for m in moves], np.full(len(moves), 1 / len(moves)))
+    engine.tree.visits[engine.tree.children(0)] = visits
+
+
+def test_decided():
+    engine = make_engine(FakeModel())
+    expand_root(engine, [30, 10, 5])
+    assert engine.decided(19, None, 0.0)
+    assert not engine.decided(20, None, 0.0)
+    # at 100 playouts a second only 10 more fit before the deadline
+    engine.search_nodes, engine.search_time = 100, 1.0
+    assert engine.decided(1000, 10.1, 10.0)
+    assert not engine.decided(1000, 10.5, 10.0)
+    only = make_engine(FakeModel())
+    expand_root(only, [1])
+    assert only.decided(1000, None, 0.0)
+
+
+def test_no_search_stops_before_its_first_playout():
+    engine = make_engine(FakeModel(), ovhd=1000)
+    control = SearchControl(engine, {'movetime': 10}, None)
+    control.deadline = control.start - 1
+    engine.stop_search.set()
+    assert not control.should_stop(0)
+    assert control.should_stop(1)
+    engine.stop_search.clear()
+    # a search whose deadline passes before its first playout still plays a move
+    engine.start()
+    move = engine.search({'movetime': 10})
+    assert engine.search_nodes >= 1
+    assert move in chess.Board().legal_moves
+
+
+def test_search_stops_early_once_decided():
+    engine = make_engine(FakeModel())
+    expand_root(engine, [30, 10, 5])
+    control = SearchControl(engine, {'nodes': 100}, None)
+    assert not control.should_stop(70)
+    assert control.should_stop(90)
+    # but not an infinite one
+    control = SearchControl(engine, {'infinite': True}, None)
+    assert not control.should_stop(90)
+
+
+def test_ponderhit_continues_as_a_timed_search():
+    engine = make_engine(FakeModel(), ovhd=0)
+    expand_root(engine, [30, 10, 5])
+    control = SearchControl(engine, {'ponder': True, 'wtime': 10000, 'nodes': 50}, None)
+    assert control.deadline is None
+    assert not control.should_stop(40)
+    engine.ponder_hit.set()
+    assert not control.should_stop(40)
+    assert not control.pondering
+    # the playouts so far count towards the node limit of the timed search
+    assert control.max_playouts == 90
+    assert control.deadline is not None
+    assert control.deadline - time.time() <= 10000 / 30 / 1000
+    assert control.should_stop(71)
+
+
+# Drive uci_engine_loop with the given commands, returning the lines it sends. A command may
+# also be a function returning one, to wait for the engine first.
+def run_uci(monkeypatch, engine, commands):
+    sent = []
+    commands = iter(commands)
+
+    def next_command():
+        command = next(commands)
+        return command if isinstance(command, str) else command(sent)
+
+    monkeypatch.setattr(play, 'print', lambda line, flush=False: sent.append(line),
+                        raising=False)
+    monkeypatch.setattr('builtins.input', next_command)
+    with pytest.raises(SystemExit):
+        play.uci_engine_loop(engine)
+    return sent
+
+
+def after(seconds, command):
+    def wait(sent):
+        time.sleep(seconds)
+        return command
+    return wait
+
+
+def once_bestmove(count, command):
+    def wait(sent):
+        deadline = time.time() + 10
+        while sum(line.startswith('bestmove') for line in sent) < count:
+            assert time.time() < deadline
+            time.sleep(0.01)
+        return command
+    return wait
+
+
+# the last info line's pv and the bestmove and ponder move that follow it
+def last_search(sent):
+    end = max(i for i, line in enumerate(sent) if line.startswith('bestmove'))
+    info = [line for line in sent[:end] if line.startswith('info depth')][-1]
+    pv = info.split(' pv ')[1].split()
+    return pv, sent[end].split()[1:]
+
+
+# The final info line describes the position searched, so its pv is legal there, and we
+# ponder on its second move when we play its first. Even at a low temperature the move
+# played may be another one with as many visits, and then there is nothing to ponder on.
+def check_search(board, pv, best):
+    board = board.copy()
+    for uci in pv:
+        move = chess.Move.from_uci(uci)
+        assert move in board.legal_moves
+        board.push(move)
+    assert best == ([pv[0], 'ponder', pv[1]] if best[0] == pv[0] else [best[0]])
+
+
+def test_uci_go_stop_and_ponderhit(monkeypatch):
+    np.random.seed(0)
+    engine = make_engine(FakeModel(), cach=0, temp=0.001)
+    sent = run_uci(monkeypatch, engine, ['uci', 'isready', 'position startpos', 'go infinite',
+                                         after(0.3, 'stop'), 'quit'])
+    assert sent[:4] == ['id name yace', 'option name Ponder type check default false',
+                        'uciok', 'readyok']
+    pv, best = last_search(sent)
+    assert len(pv) > 1
+    check_search(chess.Board(), pv, best)
+    assert engine.board.move_stack == [chess.Move.from_uci(best[0])]
+
+    engine = make_engine(FakeModel(), cach=0, temp=0.001, ovhd=0)
+    board = chess.Board()
+    board.push_uci(pv[0])
+    board.push_uci(pv[1])
+    pondering = []
+
+    def ponderhit(sent):
+        time.sleep(0.3)
+        # a ponder search only ends with ponderhit or stop
+        pondering.append(any(line.startswith('bestmove') for line in sent))
+        return 'ponderhit'
+
+    position = 'position startpos moves %s %s' % (pv[0], pv[1])
+    sent = run_uci(monkeypatch, engine, [position, 'go ponder movetime 200', ponderhit,
+                                         once_bestmove(1, 'quit')])
+    assert pondering == [False]
+    pv, best = last_search(sent)
+    check_search(board, pv, best)
+    assert len(engine.board.move_stack) == 3
@@ -0,0 +1,42 @@
+import chess
+import numpy as np
+import maximum.industries.loader as loader
+from maximum.industries.play import Engine, policy_index
+from maximum.industries.policy import FLIP_POLICY, POLICY_INDEX, move_squares
+from conftest import FakeModel
+
+
+def test_reflections_are_involutions():
+    for r in range(4):
+        assert np.array_equal(FLIP_POLICY[r][FLIP_POLICY[r]], np.arange(64 * 64))
+
+
+def test_flip_policy_matches_flip_policy_index():
+    for r in range(4):
+        expected = [loader.flip_policy_index(i, r % 2 == 1, r >= 2) for i in range(64 * 64)]
+        assert np.array_equal(FLIP_POLICY[r], expected)
+
+
+def test_policy_index_of_moves():
+    board = chess.Board('r3k2r/pPpp1ppp/8/4P3/8/8/PPPP1PPP/R3K2R w KQkq - 0 1')
+    moves = list(board.legal_moves)
+    from_squares, to_squares = move_squares(moves)
+    for r in range(4):
+        indices = POLICY_INDEX[r, from_squares, to_squares]
+        assert list(indices) == [policy_index(m, r) for m in moves]
+        assert list(indices) == [FLIP_POLICY[r, 64 * m.from_square + m.to_square] for m in moves]
+
+
+# a policy the model would output for a position in reflection r maps back to the priors
+# of the position's moves
+def test_evaluation_undoes_reflections():
+    engine = Engine(FakeModel(), {}, quiet=True)
+    moves = list(chess.Board().legal_moves)
+    rng = np.random.default_rng(0)
+    policy = rng.dirichlet(np.ones(64 * 64)).astype(np.float32)
+    expected = policy[[64 * m.from_square + m.to_square for m in moves]]
+    for r in range(4):
+        reflected = np.zeros_like(policy)
+        reflected[FLIP_POLICY[r]] = policy
+        _, priors = engine.evaluation(moves, np.zeros(1), reflected.reshape(1, -1), [r])
+        assert np.array_equal(priors, expected)
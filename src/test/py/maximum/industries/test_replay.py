@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import maximum.industries.loader as loader
+from maximum.industries.replay import ReplayBuffer
+from conftest import random_instances, write_instances
+
+
+def test_sample_round_trips_columns(instances):
+    cols = loader.to_columns(instances)
+    buffer = ReplayBuffer(len(instances), np.random.default_rng(0))
+    buffer.add(cols)
+    sample = buffer.sample(len(instances) * 2)
+    assert sample.offset[-1] == len(sample.index) == len(sample.prob)
+    # every sampled position, with its tree search results, is one of the added positions
+    expected = {(bytes(cols.board[i]), tuple(cols.index[cols.offset[i]:cols.offset[i + 1]]),
+                 tuple(cols.prob[cols.offset[i]:cols.offset[i + 1]]))
+                for i in range(len(cols.board))}
+    for i in range(len(sample.board)):
+        lo, hi = sample.offset[i], sample.offset[i + 1]
+        assert (bytes(sample.board[i]), tuple(sample.index[lo:hi]),
+                tuple(sample.prob[lo:hi])) in expected
+
+
+def test_add_evicts_oldest_positions(instances):
+    cols = loader.to_columns(instances)
+    buffer = ReplayBuffer(10)
+    buffer.add(loader.take_columns(cols, np.arange(8)))
+    buffer.add(loader.take_columns(cols, np.arange(8, 14)))
+    assert buffer.size == 10
+    assert buffer.next == 4
+    # slots 0-3 were overwritten by positions 10-13, slots 4-9 still hold positions 4-9
+    assert np.array_equal(buffer.board[:4], cols.board[10:14])
+    assert np.array_equal(buffer.board[4:], cols.board[4:10])
+
+
+def test_poll_ingests_only_new_files(tmp_path):
+    pattern = str(tmp_path / 'data.*.done')
+    for i in range(3):
+        write_instances(str(tmp_path / ('data.%d.done' % i)), random_instances(2, seed=i))
+    buffer = ReplayBuffer(100000, np.random.default_rng(0))
+    assert buffer.poll(pattern, from_last_n=2) == 2
+    size = buffer.size
+    assert size > 0
+    assert buffer.poll(pattern, from_last_n=2) == 0
+    write_instances(str(tmp_path / 'data.3.done'), random_instances(2, seed=3))
+    assert buffer.poll(pattern, from_last_n=2) == 1
+    assert buffer.size > size
+
+
+def test_sample_from_empty_buffer_raises():
+    with pytest.raises(ValueError):
+        ReplayBuffer(10).sample(4)
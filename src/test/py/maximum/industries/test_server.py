@@ -0,0 +1,44 @@
+import os
+import threading
+import time
+import chess
+import numpy as np
+from maximum.industries.play import Engine, to_model_input
+from maximum.industries.server import RemoteModel, serve
+from conftest import FakeModel
+
+
+def start_server(model, socket_path):
+    threading.Thread(target=serve, args=(model, socket_path, 16, 0.001), daemon=True).start()
+    deadline = time.time() + 10
+    while not os.path.exists(socket_path):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_remote_model_and_engine_search_through_server(tmp_path):
+    model = FakeModel()
+    socket_path = str(tmp_path / 'server.sock')
+    start_server(model, socket_path)
+    remote = RemoteModel(socket_path)
+    board = chess.Board('r3k2r/pppq1ppp/2n2n2/3pp3/3PP3/2N2N2/PPPQ1PPP/R3K2R b Kq - 4 8')
+    for inputs, positions in [(to_model_input(chess.Board()), 1), (to_model_input(board)[:1], 1)]:
+        value, policy = remote.evaluate(inputs, positions)
+        expected_value, expected_policy = model.evaluate(inputs)
+        assert value.shape == (len(inputs), 1) and policy.shape == (len(inputs), 4096)
+        assert np.allclose(value, expected_value, atol=1e-6)
+        assert np.allclose(policy, expected_policy, rtol=1e-5, atol=1e-9)
+
+    # an engine searching through the server expands the root with the model's priors
+    engine = Engine(socket_path, {'back': 'server', 'iter': '50', 'cach': '0'}, quiet=True)
+    local = Engine(model, {'iter': '1', 'cach': '0'}, quiet=True)
+    rows = model.rows
+    engine.run(engine.playouts())
+    local.run(local.playouts())
+    assert model.rows > rows
+    assert engine.search_nodes == 50
+    assert np.allclose(engine.tree.prior[engine.tree.children(0)],
+                       local.tree.prior[local.tree.children(0)], rtol=1e-5)
+    move = engine.search()
+    assert move in chess.Board().legal_moves
+    assert engine.board.move_stack == [move]
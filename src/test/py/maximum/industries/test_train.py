@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from multiprocessing import shared_memory
+import maximum.industries.loader as loader
+import maximum.industries.train as train
+from conftest import random_instances, write_instances
+
+
+@pytest.fixture
+def slot():
+    capacity = 4 * 200
+    slot = shared_memory.SharedMemory(create=True, size=train.slot_size(capacity, 0))
+    yield slot, capacity
+    slot.close()
+    slot.unlink()
+
+
+def test_fill_slot_transforms_into_the_slot(instances, slot):
+    slot, capacity = slot
+    cols = loader.to_columns(instances[:150])
+    rows = train.fill_slot(cols, slot.name, capacity, 0)
+    assert rows == 600
+    views = train.slot_views(slot.buf, capacity, rows, 0)
+    for expected, actual in zip(loader.transform_columns(cols), views):
+        assert np.array_equal(expected, actual)
+    del views
+
+
+def test_fill_slot_copies_loads_that_do_not_fit(instances, slot):
+    slot, capacity = slot
+    cols = loader.to_columns(instances[:250])
+    result = train.fill_slot(cols, slot.name, capacity, 0)
+    for expected, actual in zip(loader.transform_columns(cols), result):
+        assert np.array_equal(expected, actual)
+
+
+def test_slot_rows_fit_balanced_loads(tmp_path):
+    for i in range(4):
+        write_instances(str(tmp_path / ('data.%d.done' % i)), random_instances(3, seed=i))
+    pattern = str(tmp_path / 'data.*.done')
+    # estimated from the last 3 files
+    largest = max(train.file_positions(str(tmp_path / ('data.%d.done' % i))) for i in range(1, 4))
+    rows = train.slot_rows(pattern, 6)
+    assert rows == int(4 * 6 * largest * train.BALANCED_SHARE)
+    rng = np.random.default_rng(0)
+    loads = [4 * len(loader.load_balance(pattern, 6, rng=rng).board) for _ in range(5)]
+    assert max(loads) <= rows < 2 * np.mean(loads)
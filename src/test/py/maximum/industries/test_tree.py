@@ -0,0 +1,53 @@
+import chess
+import numpy as np
+from maximum.industries.tree import Tree, code_move, move_code
+
+
+def test_move_codes_round_trip():
+    moves = [chess.Move.from_uci(uci) for uci in ['e2e4', 'g1f3', 'e7e8q', 'a2a1n', '0000']]
+    assert [code_move(move_code(m)) for m in moves] == moves
+
+
+# a tree of the given depth in which every node has 'width' children, with distinct visits
+def full_tree(depth, width, capacity=4):
+    tree = Tree(capacity)
+    level = [0]
+    for _ in range(depth):
+        next_level = []
+        for node in level:
+            start = tree.expand(node, np.arange(1, width + 1), np.full(width, 1.0 / width))
+            next_level += list(range(start, start + width))
+        level = next_level
+    tree.visits[:tree.size] = np.arange(tree.size)
+    return tree
+
+
+# the subtree below a node as nested (move, visits, children) tuples
+def subtree(tree, node):
+    children = tree.children(node) if tree.expanded(node) else []
+    return (int(tree.move[node]), tree.visits[node], [subtree(tree, c) for c in children])
+
+
+def test_expand_grows_the_tree():
+    tree = full_tree(3, 3)
+    assert tree.size == 1 + 3 + 9 + 27
+    assert tree.capacity >= tree.size
+    assert [len(tree.children(c)) for c in tree.children(0)] == [3, 3, 3]
+
+
+def test_reroot_keeps_the_subtree_of_the_new_root():
+    tree = full_tree(3, 3)
+    child = tree.children(0)[1]
+    expected = subtree(tree, child)
+    tree.reroot(child)
+    assert tree.size == 1 + 3 + 9
+    assert subtree(tree, 0) == expected
+
+
+def test_find_child():
+    tree = Tree()
+    moves = [chess.Move.from_uci(uci) for uci in ['e2e4', 'd2d4']]
+    assert tree.find_child(0, moves[0]) == -1
+    start = tree.expand(0, [move_code(m) for m in moves], [0.5, 0.5])
+    assert tree.find_child(0, moves[1]) == start + 1
+    assert tree.find_child(0, chess.Move.from_uci('c2c4')) == -1